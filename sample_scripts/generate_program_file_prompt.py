@@ -0,0 +1,28 @@
+"""Generate a scene from a declarative program file."""
+
+import importlib
+import os
+import sys
+
+
+if "prompt_cdk" in sys.modules:
+    prompt_cdk = importlib.reload(sys.modules["prompt_cdk"])
+else:
+    import prompt_cdk
+
+SEED = None
+PROGRAM_FILE = os.path.join(
+    os.path.dirname(prompt_cdk.__file__),
+    "conditional_scene.json",
+)
+
+# The file is parsed only when it changes; later runs reuse the program.
+program = prompt_cdk.load_program(PROGRAM_FILE)
+
+scene = program.synth(seed=SEED)
+positive_prompt = scene.prompt(prefix="masterpiece, best quality")
+negative_prompt = scene.negative_prompt("low quality, blurry")
+
+print(f"[{program.name}] selection: {scene.summary()}")
+print(f"[{program.name}] positive: {positive_prompt}")
+print(f"[{program.name}] negative: {negative_prompt}")
@@ -1,10 +1,51 @@
 """Small CDK-like framework for constrained random prompt generation."""
 
-from dataclasses import dataclass
+import hashlib
+import heapq
+import json
+import os
+import pickle
+import sys
+from array import array
+from bisect import bisect, bisect_left
+from collections import OrderedDict
+from collections.abc import Mapping
+from dataclasses import dataclass, fields, is_dataclass, replace
+from itertools import accumulate, combinations, count, islice, product
+from math import ceil, exp, expm1, log, log1p, prod
+from operator import itemgetter
 from random import Random
-
-
-@dataclass(frozen=True)
+from time import monotonic
+from zipfile import ZIP_DEFLATED, ZipFile
+
+try:
+    import numpy
+except ImportError:  # NumPy is always available inside ComfyUI.
+    numpy = None
+
+try:
+    import tomllib
+except ImportError:  # Python 3.10 reads JSON program files only.
+    tomllib = None
+
+# Compiled tables shared by every program in the process.  The sample scripts
+# reload this module on every run, so the cache is kept across reloads.
+try:
+    _compiled_cache
+except NameError:
+    _compiled_cache = {"entries": OrderedDict(), "maxsize": 64, "directory": None}
+# Pickled sizes of the cached tables, added after the cache was first shipped.
+_compiled_cache.setdefault("sizes", {})
+_compiled_cache.setdefault("max_bytes", 256 * 2**20)
+
+# Programs loaded from files, by absolute path, kept across reloads as well.
+try:
+    _program_files
+except NameError:
+    _program_files = {}
+
+
+@dataclass(frozen=True, slots=True)
 class Option:
     key: str
     prompt: str | tuple[str, ...]
@@ -32,7 +73,7 @@ def option(key, prompt, *tags, weight=1.0, negative="", break_before=False):
     )
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Dimension:
     """Reusable dimension definition."""
 
@@ -47,7 +88,93 @@ def dimension(name, *options, break_before=False):
     return Dimension(name, tuple(options), bool(break_before))
 
 
-@dataclass(frozen=True)
+def load_dimensions(path):
+    """Read reusable Dimension definitions from a JSON or TOML file.
+
+    The file holds a ``dimensions`` table mapping a definition name to the
+    dimension's ``name``, ``options`` and optional ``break_before``.
+    """
+    path = os.fspath(path)
+    with open(path, "rb") as file:
+        data = _parse_program_file(path, file.read())
+    return _dimension_definitions(data.get("dimensions", {}), path)
+
+
+def load_program(path):
+    """Build a PromptProgram from a JSON or TOML program file.
+
+    The program is built once and returned again while the file and the
+    files it includes are unchanged.  Modification times are checked first
+    and contents only when they differ, so loading an unchanged program costs
+    a few stat calls.  Each call returns its own copy, so calibrating or
+    extending one does not change the program other callers receive.
+    """
+    path = os.path.abspath(os.fspath(path))
+    cached = _program_files.get(path)
+    if cached is not None and cached["source"] == _SOURCE_HASH:
+        files = [file for file, _modified, _size in cached["stamps"]]
+        if _file_stamps(files) == cached["stamps"]:
+            return cached["program"]._copy()
+    data, dimensions, contents = _read_program_files(path)
+    digest = hashlib.sha256()
+    for file, content in contents:
+        digest.update(file.encode("utf-8") + b"\0" + content)
+    stamps = _file_stamps([file for file, _content in contents])
+    if (
+        cached is not None
+        and cached["source"] == _SOURCE_HASH
+        and cached["digest"] == digest.hexdigest()
+    ):
+        cached["stamps"] = stamps
+        return cached["program"]._copy()
+
+    program = PromptProgram(
+        data.get("name", os.path.splitext(os.path.basename(path))[0]),
+        max_states=data.get("max_states", 2_000_000),
+        time_limit=data.get("time_limit", 60),
+    )
+    _build_elements(program, data.get("elements", []), dimensions, path)
+    _program_files[path] = {
+        "source": _SOURCE_HASH,
+        "stamps": stamps,
+        "digest": digest.hexdigest(),
+        "program": program,
+    }
+    return program._copy()
+
+
+def configure_cache(*, maxsize=64, max_bytes=256 * 2**20, directory=None):
+    """Size the process-wide cache of compiled tables and optionally persist it.
+
+    The cache keeps at most ``maxsize`` tables and, unless ``max_bytes`` is
+    None, at most about ``max_bytes`` of them as measured by their pickled
+    size; the least recently used tables are dropped first.
+
+    With ``directory``, compiled tables are also pickled there and loaded by
+    later processes.  Files in it are unpickled without any check, so anyone
+    who can write to the directory can run code in this process; only point
+    it at a directory you trust.
+    """
+    if maxsize < 0:
+        raise ValueError("maxsize must not be negative")
+    if max_bytes is not None and max_bytes < 0:
+        raise ValueError("max_bytes must not be negative")
+    if directory is not None:
+        directory = os.fspath(directory)
+        os.makedirs(directory, exist_ok=True)
+    _compiled_cache["maxsize"] = maxsize
+    _compiled_cache["max_bytes"] = max_bytes
+    _compiled_cache["directory"] = directory
+    _trim_cache()
+
+
+def clear_cache():
+    """Drop the compiled tables kept in memory; files on disk are kept."""
+    _compiled_cache["entries"].clear()
+    _compiled_cache["sizes"].clear()
+
+
+@dataclass(frozen=True, slots=True)
 class Condition:
     dimension: str
     keys: frozenset[str] = frozenset()
@@ -55,16 +182,18 @@ class Condition:
     match: str = "all"
 
     def matches(self, selection):
-        selected = selection.get(self.dimension)
+        return self.matches_option(selection.get(self.dimension))
+
+    def matches_option(self, selected):
+        """Check one selected option, or None for an absent dimension."""
         if selected is None:
             return False
         if self.keys and selected.key not in self.keys:
             return False
         if self.tags:
-            tag_matches = [selected.has_tag(tag) for tag in self.tags]
-            if self.match == "all" and not all(tag_matches):
+            if self.match == "all" and not self.tags <= selected.tags:
                 return False
-            if self.match == "any" and not any(tag_matches):
+            if self.match == "any" and self.tags.isdisjoint(selected.tags):
                 return False
         return True
 
@@ -77,16 +206,23 @@ class Condition:
         return f"{self.dimension}({', '.join(criteria)})"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Rule:
     trigger: Condition
     target: Condition
     mode: str
 
     def accepts(self, selection):
-        if not self.trigger.matches(selection):
+        return self.accepts_options(
+            selection.get(self.trigger.dimension),
+            selection.get(self.target.dimension),
+        )
+
+    def accepts_options(self, trigger, target):
+        """Check the options selected in the trigger and target dimensions."""
+        if not self.trigger.matches_option(trigger):
             return True
-        target_matches = self.target.matches(selection)
+        target_matches = self.target.matches_option(target)
         return target_matches if self.mode == "require" else not target_matches
 
     def describe(self):
@@ -94,15 +230,64 @@ class Rule:
         return f"{self.trigger.describe()} {verb} {self.target.describe()}"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class ConditionalBranch:
     trigger: Condition
     options: tuple[Option, ...]
 
 
-@dataclass(frozen=True)
+class SelectionView(Mapping):
+    """Read-only mapping of dimension names to options, built on access.
+
+    A view stores only the option index of each dimension and shares the
+    names and options of the compiled program with every other view.
+    """
+
+    __slots__ = ("_model", "_assignment")
+
+    def __init__(self, model, assignment):
+        self._model = model
+        self._assignment = assignment
+
+    def __getitem__(self, name):
+        if name in self._model.multi_vars:
+            return self._model.multi_selection(name, self._assignment)
+        position = self._model.index[name]
+        if position in self._model.multi_owner:
+            raise KeyError(name)
+        selected = self._model.values[position][self._assignment[position]]
+        if selected is None:
+            raise KeyError(name)
+        return selected
+
+    def __iter__(self):
+        for position, name in enumerate(self._model.names):
+            owner = self._model.multi_owner.get(position)
+            if owner is not None:
+                # A multi-select dimension is listed once, at its first option.
+                if position == self._model.multi_vars[owner][0]:
+                    yield owner
+            elif self._model.values[position][self._assignment[position]] is not None:
+                yield name
+
+    def __len__(self):
+        return sum(1 for _name in self)
+
+    def __contains__(self, name):
+        if name in self._model.multi_vars:
+            return True
+        position = self._model.index.get(name)
+        if position is None or position in self._model.multi_owner:
+            return False
+        return self._model.values[position][self._assignment[position]] is not None
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
+
+
+@dataclass(frozen=True, slots=True)
 class Scene:
-    selection: dict[str, Option]
+    selection: Mapping[str, Option]
     elements: tuple[tuple[str, str | None], ...]
 
     def prompt(self, prefix="masterpiece, best quality, solo"):
@@ -116,29 +301,59 @@ class Scene:
             elif element_type == "fixed":
                 lines.append(value)
             elif element_type == "dimension":
-                selected = self.selection.get(value)
-                if selected is None:
-                    continue
-                if selected.break_before and lines and lines[-1] != "BREAK":
-                    lines.append("BREAK")
-                if selected.prompt:
-                    if isinstance(selected.prompt, str):
-                        lines.append(selected.prompt)
-                    else:
-                        lines.extend(selected.prompt)
+                for selected in _chosen_options(self.selection.get(value)):
+                    if selected.break_before and lines and lines[-1] != "BREAK":
+                        lines.append("BREAK")
+                    if selected.prompt:
+                        if isinstance(selected.prompt, str):
+                            lines.append(selected.prompt)
+                        else:
+                            lines.extend(selected.prompt)
 
         return self._render_lines(lines)
 
     def summary(self):
-        return {name: selected.key for name, selected in self.selection.items()}
+        """Map dimension names to option keys; a tuple for multi-select ones."""
+        return {
+            name: (
+                tuple(choice.key for choice in selected)
+                if isinstance(selected, tuple)
+                else selected.key
+            )
+            for name, selected in self.selection.items()
+        }
+
+    def mutate(self, k=1, seed=None):
+        """Return a variation with ``k`` dimensions chosen again.
+
+        The ``k`` dimensions are picked at random among those in the scene,
+        passing over dimensions that the rules pin to their current option
+        given the rest, and redrawn by weight given every other dimension,
+        together with the conditional dimensions that depend on them.  The
+        variation differs from this scene unless the rules leave no other
+        choice.  When no single dimension can change, only groups linked by
+        rules are tried, within the program's ``time_limit``.
+        """
+        if not isinstance(self.selection, SelectionView):
+            raise TypeError("Only scenes selected by a PromptProgram can be mutated")
+        model = self.selection._model
+        assignment = _mutate(
+            model,
+            list(self.selection._assignment),
+            k,
+            Random(seed),
+            model.budget(),
+        )
+        return Scene(model.selection(assignment), self.elements)
 
     def negative_prompt(self, base=""):
         """Combine the base negative prompt with selected option negatives."""
         lines = [base]
         lines.extend(
-            selected.negative
+            choice.negative
             for selected in self.selection.values()
-            if selected.negative
+            for choice in _chosen_options(selected)
+            if choice.negative
         )
         return self._render_lines([line for line in lines if line])
 
@@ -160,6 +375,162 @@ class Scene:
         return "\n".join(rendered)
 
 
+class SceneBatch:
+    """Many scenes of one program stored as option indices per dimension.
+
+    Each dimension is one small unsigned integer column, so a million scenes
+    take a few megabytes.  Scenes and prompts are built only when a row is
+    read.  Batches from synth_many() record the ``engine`` that drew them,
+    so a choice made by engine="auto" can be checked.  Batches drawn by the
+    gibbs engine report their effective sample size; it is None for every
+    other batch, and ``engine`` is None for batches built other ways.
+    """
+
+    def __init__(self, model, columns, size, elements):
+        self._model = model
+        self._columns = columns
+        self._size = size
+        self.elements = elements
+        self.engine = None
+        self.effective_sample_size = None
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            batch = SceneBatch(
+                self._model,
+                [column[index] for column in self._columns],
+                len(range(self._size)[index]),
+                self.elements,
+            )
+            batch.engine = self.engine
+            return batch
+        if not -self._size <= index < self._size:
+            raise IndexError("SceneBatch index out of range")
+        if index < 0:
+            index += self._size
+        return Scene(self._model.selection(self._row(index)), self.elements)
+
+    def __iter__(self):
+        for index in range(self._size):
+            yield self[index]
+
+    def __add__(self, other):
+        if not isinstance(other, SceneBatch):
+            return NotImplemented
+        return SceneBatch.concatenate([self, other])
+
+    def prompt(self, index, prefix="masterpiece, best quality, solo"):
+        """Render the positive prompt of one row."""
+        return self[index].prompt(prefix)
+
+    def negative_prompt(self, index, base=""):
+        """Render the negative prompt of one row."""
+        return self[index].negative_prompt(base)
+
+    @classmethod
+    def concatenate(cls, batches):
+        """Join batches drawn from the same program into one batch."""
+        batches = list(batches)
+        if not batches:
+            raise ValueError("At least one SceneBatch is required")
+        first = batches[0]
+        if any(
+            batch._model.names != first._model.names
+            or batch._model.values != first._model.values
+            for batch in batches[1:]
+        ):
+            raise ValueError("Scene batches from different programs cannot be combined")
+        columns = []
+        for var in range(len(first._columns)):
+            parts = [batch._columns[var] for batch in batches]
+            if numpy is None:
+                column = array(parts[0].typecode)
+                for part in parts:
+                    column.extend(part)
+            else:
+                column = numpy.concatenate([numpy.asarray(part) for part in parts])
+            columns.append(column)
+        return cls(
+            first._model,
+            columns,
+            sum(len(batch) for batch in batches),
+            first.elements,
+        )
+
+    def save(self, path):
+        """Write the batch to a zip file that load() reads back."""
+        header = {
+            "format": 1,
+            "size": self._size,
+            "dimensions": [
+                {
+                    "name": name,
+                    "keys": [None if value is None else value.key for value in values],
+                    "itemsize": _itemsize(column),
+                }
+                for name, values, column in zip(
+                    self._model.names,
+                    self._model.values,
+                    self._columns,
+                )
+            ],
+        }
+        with ZipFile(path, "w", compression=ZIP_DEFLATED) as archive:
+            archive.writestr("header.json", json.dumps(header))
+            for var, column in enumerate(self._columns):
+                archive.writestr(f"{var}.bin", _column_bytes(column))
+
+    @classmethod
+    def load(cls, path, program):
+        """Read a saved batch; ``program`` must define the same dimensions."""
+        model = program._compile("model")
+        with ZipFile(path) as archive:
+            header = json.loads(archive.read("header.json"))
+            saved = [
+                (dimension["name"], dimension["keys"])
+                for dimension in header["dimensions"]
+            ]
+            current = [
+                (name, [None if value is None else value.key for value in values])
+                for name, values in zip(model.names, model.values)
+            ]
+            if saved != current:
+                raise ValueError(
+                    f"Saved scene batch does not match program {program.name}"
+                )
+            columns = [
+                _column_from_bytes(archive.read(f"{var}.bin"), dimension["itemsize"])
+                for var, dimension in enumerate(header["dimensions"])
+            ]
+        return cls(model, columns, header["size"], tuple(program.elements))
+
+    def _row(self, index):
+        return tuple(int(column[index]) for column in self._columns)
+
+
+@dataclass(frozen=True, slots=True)
+class ProgramAnalysis:
+    """Result of PromptProgram.analyze().
+
+    ``dead_options`` maps dimension names to the option keys that can never
+    be selected, and ``fixed_dimensions`` maps dimension names to the only
+    key they can take (None for a conditional dimension that is never
+    present).  ``conflict`` is a minimal set of rules that leaves no valid
+    scene; it is empty when the program has valid scenes.
+    """
+
+    dead_options: dict[str, tuple[str, ...]]
+    fixed_dimensions: dict[str, str | None]
+    conflict: tuple[Rule, ...]
+
+    @property
+    def satisfiable(self):
+        return not self.conflict
+
+
 class ConstraintBuilder:
     def __init__(self, program, trigger, resolve_dimension=None, return_target=None):
         self.program = program
@@ -245,12 +616,14 @@ class PromptBlock:
         self.program._add_fixed(value)
         return self
 
-    def dimension(self, name, *options, break_before=False):
+    def dimension(self, name, *options, break_before=False, min=None, max=None):
         name, options, template_break = _dimension_arguments(name, options)
         self.program._add_dimension(
             self._scope(name),
             options,
             break_before=break_before or template_break,
+            minimum=min,
+            maximum=max,
         )
         return self
 
@@ -292,22 +665,42 @@ class PromptBlock:
 
 
 class PromptProgram:
-    """Define prompt dimensions and synthesize a valid random scene."""
+    """Define prompt dimensions and synthesize a valid random scene.
+
+    ``max_states`` caps the number of table rows or partial combinations an
+    engine may build, and ``time_limit`` caps the seconds spent building
+    tables or running a sampling loop.  Exceeding either raises an error
+    instead of freezing the caller; pass ``time_limit=None`` to let a call
+    run for as long as it takes.
+    """
 
-    def __init__(self, name):
+    def __init__(self, name, *, max_states=2_000_000, time_limit=60):
         self.name = name
+        self.max_states = max_states
+        self.time_limit = time_limit
         self.dimensions = {}
         self.conditional_dimensions = {}
+        # Multi-select dimensions, by name, with their (min, max) counts.
+        self.multi_select = {}
         self.elements = []
         self.block_names = set()
         self.rules = []
+        self._compiled = {}
+
+    def dimension(self, name, *options, break_before=False, min=None, max=None):
+        """Add a dimension that selects one of ``options``.
 
-    def dimension(self, name, *options, break_before=False):
+        Passing ``min`` or ``max`` makes it a multi-select dimension that
+        selects between ``min`` (default 0) and ``max`` (default all) of its
+        options at once.
+        """
         name, options, template_break = _dimension_arguments(name, options)
         self._add_dimension(
             name,
             options,
             break_before=break_before or template_break,
+            minimum=min,
+            maximum=max,
         )
         return self
 
@@ -321,6 +714,7 @@ class PromptProgram:
         if name in self.block_names:
             raise ValueError(f"Block already exists: {name}")
         self.block_names.add(name)
+        self._changed()
         if break_before:
             self._add_break()
         block = PromptBlock(self, name)
@@ -356,42 +750,1165 @@ class PromptProgram:
             resolve_dimension=self._program_scope,
         )
 
-    def synth(self, seed=None):
-        if self.elements and self.elements[-1][0] == "break":
-            raise ValueError("break_() must be followed by prompt content")
+    def synth(self, seed=None, *, engine="auto", burn_in=100, thin=1):
+        """Select one valid scene.
+
+        The sequential engine samples one dimension at a time, weighting each
+        option by the total weight of the valid completions that remain.  The
+        enumerate engine builds every combination and filters it afterwards.
+        The rejection engine draws every dimension independently and retries
+        until the rules hold.  All three draw exactly from the same
+        distribution.  The gibbs engine runs a Markov chain for ``burn_in``
+        sweeps instead, for programs too large for the exact engines.  The
+        auto engine picks one of them from estimates of the program's size.
+        """
+        self._validate_elements()
+        _validate_engine(engine, burn_in, thin)
+        engine = self._engine(engine)
+        rng = Random(seed)
+        if engine == "gibbs":
+            assignment = self._gibbs_rows(1, rng, burn_in, thin, self._budget())[0]
+        else:
+            assignment = self._draw(engine, rng, self._budget())
+        return self._scene(assignment)
 
-        states = [({}, 1.0)]
-        for element_type, name in self.elements:
-            if element_type != "dimension":
+    def synth_many(
+        self,
+        n,
+        seed=None,
+        *,
+        engine="auto",
+        method="random",
+        burn_in=100,
+        thin=1,
+    ):
+        """Select ``n`` valid scenes in one pass and return them as a SceneBatch.
+
+        The draws follow the same distribution as repeated synth() calls.  With
+        NumPy the sequential engine draws every dimension for the whole batch
+        at once, and the auto engine picks it whenever its tables fit;
+        otherwise the scenes are drawn one by one.  The gibbs engine
+        keeps one scene every ``thin`` sweeps after ``burn_in`` sweeps and
+        reports the batch's effective sample size.
+
+        ``method="qmc"`` feeds the sequential engine a scrambled Halton
+        sequence instead of independent random numbers, so that even small
+        batches spread over the options in proportion to their weights.
+        """
+        self._validate_elements()
+        _validate_engine(engine, burn_in, thin)
+        if method not in {"random", "qmc"}:
+            raise ValueError("method must be 'random' or 'qmc'")
+        if n < 0:
+            raise ValueError("n must not be negative")
+        if method == "qmc":
+            if engine not in {"auto", "sequential"}:
+                raise ValueError("method 'qmc' needs the sequential engine")
+            sampler = self._compile("sequential")
+            points = _halton(n, len(sampler.buckets), Random(seed))
+            batch = self._batch([sampler.transform(point) for point in points])
+            batch.engine = "sequential"
+            return batch
+        engine = self._compile("batch_plan") if engine == "auto" else engine
+        batch = self._draw_batch(n, seed, engine, burn_in, thin)
+        batch.engine = engine
+        return batch
+
+    def _draw_batch(self, n, seed, engine, burn_in, thin):
+        if engine == "gibbs":
+            # Sampling and the diagnostics share one time limit.
+            budget = self._budget()
+            rows = self._gibbs_rows(n, Random(seed), burn_in, thin, budget)
+            batch = self._batch(rows)
+            batch.effective_sample_size = _effective_sample_size(
+                rows,
+                self._compile("model").sizes,
+                budget,
+            )
+            return batch
+        if engine != "sequential" or numpy is None:
+            rng = Random(seed)
+            budget = self._budget()
+            return self._batch(
+                [self._draw(engine, rng, budget) for _index in range(n)]
+            )
+        columns = self._compile("vectorized").sample(
+            n,
+            numpy.random.default_rng(seed),
+        )
+        return SceneBatch(self._compile("model"), columns, n, tuple(self.elements))
+
+    def _engine(self, engine):
+        return self._compile("plan") if engine == "auto" else engine
+
+    def _budget(self):
+        return _Budget(self.name, self.max_states, self.time_limit)
+
+    def _draw(self, engine, rng, budget):
+        if engine == "rejection":
+            assignment = self._compile(engine).sample(rng, budget)
+            if assignment is not None:
+                return assignment
+            # Falling back to an exact engine keeps the distribution intact.
+            engine = "sequential"
+        if engine == "sequential":
+            return self._compile(engine).sample(rng)
+        assignment = [None] * len(self._compile("model").names)
+        for component, candidates, cumulative in self._compile(engine):
+            row = _draw(candidates, cumulative, rng.random())
+            for var, value in zip(component, row):
+                assignment[var] = value
+        return assignment
+
+    def _gibbs_rows(self, n, rng, burn_in, thin, budget):
+        rows = self._compile("gibbs").run(n, rng, burn_in, thin, budget)
+        if rows is None:
+            self._raise_no_combinations()
+        return rows
+
+    def sample_distinct(self, n, seed=None):
+        """Select ``n`` different valid scenes, weighted, without replacement.
+
+        Scenes are returned in draw order: each one is picked in proportion to
+        its weight among the scenes not picked yet.  Small programs give every
+        valid scene a Gumbel key and keep the largest keys; larger programs
+        run a stochastic beam search over the sequential sampler, which draws
+        the same keys one dimension at a time.
+        """
+        self._validate_elements()
+        if n < 0:
+            raise ValueError("n must not be negative")
+        total = self.count()
+        if n > total:
+            raise ValueError(
+                f"Cannot select {n} distinct scenes from {total} valid "
+                f"combinations of {self.name}"
+            )
+        if not n:
+            return self._batch([])
+        model = self._compile("model")
+        sampler = self._compile("sequential")
+        rng = Random(seed)
+        if total <= max(4 * n, 1024):
+            weights = model.weights()
+            keyed = (
+                (
+                    sum(
+                        log(weights[var][value])
+                        for var, value in enumerate(assignment)
+                    )
+                    + _gumbel(rng),
+                    assignment,
+                )
+                for assignment in sampler.assignments()
+            )
+            rows = [row for _key, row in heapq.nlargest(n, keyed, key=itemgetter(0))]
+        else:
+            rows = sampler.sample_distinct(n, rng)
+        return self._batch(rows)
+
+    def sample_stratified(self, n, quotas, seed=None):
+        """Select ``n`` valid scenes whose options meet fixed quotas.
+
+        ``quotas`` maps dimension names to ``{option key: share}``; the shares
+        are split into whole counts that add up to ``n``, and options missing
+        from a dimension's quotas are never picked.  Quota options are handed
+        out one scene at a time as combinations over all quota dimensions,
+        keeping a plan that proves the remaining counts still fit the rules
+        together, and the other dimensions are then drawn from the
+        constrained distribution given those options.
+        """
+        self._validate_elements()
+        if n < 0:
+            raise ValueError("n must not be negative")
+        model = self._compile("model")
+        sampler = self._compile("sequential")
+        counts = self._quota_counts(model, n, quotas)
+        rng = Random(seed)
+        budget = self._budget()
+        totals = {}
+
+        def restricted(chosen):
+            weights = [list(values) for values in model.weights()]
+            for (var, _counts), key in zip(counts, chosen):
+                for value, selected in enumerate(model.values[var]):
+                    if (None if selected is None else selected.key) != key:
+                        weights[var][value] = 0
+            return weights
+
+        def total(chosen):
+            if chosen not in totals:
+                totals[chosen] = _Elimination(
+                    model,
+                    restricted(chosen),
+                    order=sampler.order,
+                    budget=budget,
+                ).total
+            return totals[chosen]
+
+        # Quota options are handled by index.  A combination holds one option
+        # index per quota dimension and is kept only when a valid scene has
+        # all of its options, so the plan covers every dimension at once.
+        keys = [[key for key, count in demand.items() if count] for _var, demand in counts]
+
+        def keyed(combination):
+            return tuple(options[index] for options, index in zip(keys, combination))
+
+        candidates = [()]
+        remaining = ()
+        plan = {(): n}
+        for (var, demand), options in zip(counts, keys):
+            candidates = [
+                combination + (index,)
+                for combination in candidates
+                for index in range(len(options))
+                if total(keyed(combination + (index,)))
+            ]
+            remaining += (tuple(demand[key] for key in options),)
+            plan = _quota_plan(
+                {combination: total(keyed(combination)) for combination in candidates},
+                remaining,
+                rng,
+                budget,
+            )
+            if plan is None:
+                raise ValueError(
+                    f"Cannot meet the quotas for {model.names[var]} in {self.name}"
+                )
+        chosen = [
+            keyed(combination)
+            for combination, amount in plan.items()
+            for _index in range(amount)
+        ]
+        rng.shuffle(chosen)
+        samplers = {}
+        rows = []
+        for partial in chosen:
+            if partial not in samplers:
+                samplers[partial] = _Elimination(
+                    model,
+                    restricted(partial),
+                    order=sampler.order,
+                    budget=budget,
+                )
+            rows.append(samplers[partial].sample(rng))
+        return self._batch(rows)
+
+    @staticmethod
+    def _quota_counts(model, n, quotas):
+        counts = []
+        for name, shares in quotas.items():
+            if name in model.multi_vars:
+                raise ValueError(
+                    f"Quotas are not supported for multi-select dimension: {name}"
+                )
+            if name not in model.index:
+                raise KeyError(f"Unknown dimension: {name}")
+            var = model.index[name]
+            keys = {
+                None if selected is None else selected.key
+                for selected in model.values[var]
+            }
+            for key, share in shares.items():
+                if key not in keys:
+                    raise KeyError(f"Unknown option: {name}.{key}")
+                if not share > 0:
+                    raise ValueError("Quota shares must be greater than 0")
+            counts.append((var, _apportion(n, shares)))
+        counts.sort(key=itemgetter(0))
+        return counts
+
+    def covering_set(self, strength=2):
+        """Return a small SceneBatch that covers every valid option ``strength``-tuple.
+
+        Every combination of options from ``strength`` different dimensions
+        that appears in some valid scene appears in at least one returned
+        scene.  Scenes are built greedily: each one starts from a tuple that
+        is still missing, and the other dimensions are filled in sampling
+        order with the option that covers the most missing tuples, checked
+        against the elimination tables so that a valid scene always remains.
+        Each option of a multi-select dimension counts as a dimension of its
+        own.
+        """
+        self._validate_elements()
+        if strength < 1:
+            raise ValueError("strength must be at least 1")
+        model = self._compile("model")
+        sampler = self._compile("sequential")
+        budget = self._budget()
+        strength = min(strength, len(model.sizes))
+        # A multi-select variable has one value per running count; tuples use
+        # the first value of each option instead.
+        canonical = [
+            [
+                values.index(selected) if var in model.multi_owner else value
+                for value, selected in enumerate(values)
+            ]
+            for var, values in enumerate(model.values)
+        ]
+        alive = [
+            list(
+                dict.fromkeys(
+                    canonical[var][value]
+                    for value, probability in enumerate(probabilities)
+                    if probability and model.values[var][value] is not None
+                )
+            )
+            for var, probabilities in enumerate(sampler.marginals())
+        ]
+        merged = {}
+        # Counts are left to the forced elimination below.
+        for scope, table in model.branch_constraints + [
+            constraint
+            for constraints in model.rule_constraints
+            for constraint in constraints
+        ]:
+            if scope in merged:
+                merged[scope] &= table.keys()
+            else:
+                merged[scope] = set(table)
+        missing = {}
+        pending = {}
+        for variables in combinations(range(len(model.sizes)), strength):
+            checks = [
+                (tuple(variables.index(var) for var in scope), table)
+                for scope, table in merged.items()
+                if set(scope) <= set(variables)
+            ]
+            for values in product(*(alive[var] for var in variables)):
+                if all(
+                    tuple(values[position] for position in positions) in table
+                    for positions, table in checks
+                ):
+                    combination = tuple(zip(variables, values))
+                    missing[combination] = None
+                    for pair in combination:
+                        pending[pair] = pending.get(pair, 0) + 1
+
+        rows = []
+        while missing:
+            budget.check()
+            target = next(iter(missing))
+            weights = [list(values) for values in model.weights()]
+            for var, value in target:
+                weights[var] = [
+                    weight if canonical[var][other] == value else 0
+                    for other, weight in enumerate(weights[var])
+                ]
+            forced = _Elimination(model, weights, order=sampler.order, budget=budget)
+            if not forced.total:
+                # Only several rules together rule this tuple out.
+                self._cover(missing, pending, target)
                 continue
+            assignment = [None] * len(model.sizes)
+            chosen = []
+            for var, context, table in reversed(forced.buckets):
+                values, _cumulative = table[
+                    tuple(assignment[other] for other in context)
+                ]
+                value = max(
+                    values,
+                    key=lambda value: (
+                        sum(
+                            tuple(sorted(others + ((var, canonical[var][value]),)))
+                            in missing
+                            for others in combinations(chosen, strength - 1)
+                        ),
+                        pending.get((var, canonical[var][value]), 0),
+                        -value,
+                    ),
+                )
+                assignment[var] = value
+                if model.values[var][value] is not None:
+                    chosen.append((var, canonical[var][value]))
+            chosen.sort()
+            for combination in combinations(chosen, strength):
+                self._cover(missing, pending, combination)
+            rows.append(assignment)
+        return self._batch(rows)
+
+    @staticmethod
+    def _cover(missing, pending, combination):
+        if combination in missing:
+            del missing[combination]
+            for pair in combination:
+                pending[pair] -= 1
+
+    def _batch(self, rows):
+        model = self._compile("model")
+        if numpy is None:
+            columns = [
+                array(_typecode(size), (row[var] for row in rows))
+                for var, size in enumerate(model.sizes)
+            ]
+        else:
+            columns = [
+                numpy.fromiter(
+                    (row[var] for row in rows),
+                    dtype=numpy.min_scalar_type(size - 1),
+                    count=len(rows),
+                )
+                for var, size in enumerate(model.sizes)
+            ]
+        return SceneBatch(model, columns, len(rows), tuple(self.elements))
+
+    def analyze(self):
+        """Report dead options, fixed dimensions and conflicting rules.
+
+        Arc consistency over the rules and conditional branches removes every
+        option that some rule or branch cannot support given the options left
+        in the other dimensions.  It never enumerates combinations, so it is
+        cheap, but an option excluded only by several rules together may
+        still be reported as alive.  When no valid scene exists, rules are
+        dropped one at a time while the rest still conflict, which leaves a
+        minimal conflicting set.
+        """
+        self._validate_elements()
+        model = self._compile("model")
+        conflict = self._conflict(model)
+        if conflict:
+            domains = [() for _size in model.sizes]
+        else:
+            domains = _arc_consistency(model.sizes, model.constraints)
+
+        dead_options = {}
+        fixed_dimensions = {}
+        for var, (name, values, domain) in enumerate(
+            zip(model.names, model.values, domains)
+        ):
+            alive = {values[value] for value in domain}
+            if var in model.multi_owner:
+                # One option of a multi-select dimension; it is dead when it
+                # can never be selected.
+                name = model.multi_owner[var]
+                if alive <= {None}:
+                    key = next(value for value in values if value is not None).key
+                    dead_options[name] = dead_options.get(name, ()) + (key,)
+                continue
+            dead = tuple(
+                dict.fromkeys(
+                    value.key
+                    for value in values
+                    if value is not None
+                    and not any(
+                        selected is not None and selected.key == value.key
+                        for selected in alive
+                    )
+                )
+            )
+            if dead:
+                dead_options[name] = dead
+            keys = {None if selected is None else selected.key for selected in alive}
+            if len(keys) == 1:
+                fixed_dimensions[name] = keys.pop()
+        return ProgramAnalysis(dead_options, fixed_dimensions, conflict)
+
+    def marginals(self):
+        """Return the exact probability of every option under the rules.
+
+        The result maps each dimension to its option keys, plus None for a
+        conditional dimension that is absent, with the probability that
+        synth() selects them.  For a multi-select dimension it is the
+        probability that the option is among the selected ones.  It is
+        computed from the sequential engine's tables without enumerating
+        combinations.
+        """
+        self._validate_elements()
+        return self._keyed_marginals(
+            self._compile("model"),
+            self._compile("sequential").marginals(),
+        )
+
+    def calibrate(self, targets, *, tolerance=1e-6, max_iterations=500):
+        """Adjust option weights until the selection frequencies hit ``targets``.
+
+        ``targets`` maps dimension names to ``{option key: frequency}``.  The
+        weights of the listed options are scaled by iterative proportional
+        fitting, and the other options of the same dimension share the rest
+        of the probability in their current proportions.  On a multi-select
+        dimension each listed option has its odds of being selected scaled
+        on its own, and the other options keep their weights.
+        """
+        self._validate_elements()
+        model = self._compile("model")
+        # Raises the usual error when the program has no valid scene.
+        order = self._compile("sequential").order
+        self._check_targets(model, targets)
+        budget = self._budget()
+        weights = [list(values) for values in model.weights()]
+
+        def fitted_marginals():
+            return self._keyed_marginals(
+                model,
+                _Elimination(model, weights, order=order, budget=budget).marginals(),
+            )
+
+        for _iteration in range(max_iterations):
+            marginals = fitted_marginals()
+            if all(
+                abs(marginals[name][key] - frequency) <= tolerance
+                for name, frequencies in targets.items()
+                for key, frequency in frequencies.items()
+            ):
+                break
+            # Fit one dimension at a time against fresh marginals.
+            for name, frequencies in targets.items():
+                self._fit_dimension(model, weights, name, frequencies, marginals[name])
+                marginals = fitted_marginals()
+        else:
+            raise ValueError(
+                f"Could not reach the target frequencies for {self.name} "
+                f"within {max_iterations} iterations"
+            )
+        self._set_weights(model, weights)
+        return self
+
+    @staticmethod
+    def _check_targets(model, targets):
+        for name, frequencies in targets.items():
+            if name in model.multi_vars:
+                keys = {selected.key for selected in model.multi_options[name]}
+                for key, frequency in frequencies.items():
+                    if key not in keys:
+                        raise KeyError(f"Unknown option: {name}.{key}")
+                    if not 0 < frequency < 1:
+                        raise ValueError(
+                            "Target frequencies of multi-select options must be "
+                            "greater than 0 and less than 1"
+                        )
+                continue
+            if name not in model.index:
+                raise KeyError(f"Unknown dimension: {name}")
+            keys = {
+                selected.key
+                for selected in model.values[model.index[name]]
+                if selected is not None
+            }
+            for key, frequency in frequencies.items():
+                if key not in keys:
+                    raise KeyError(f"Unknown option: {name}.{key}")
+                if not 0 < frequency <= 1:
+                    raise ValueError("Target frequencies must be greater than 0 and at most 1")
+            if sum(frequencies.values()) > 1 + 1e-9:
+                raise ValueError(f"Target frequencies for {name} add up to more than 1")
+
+    @staticmethod
+    def _fit_dimension(model, weights, name, frequencies, current):
+        if name in model.multi_vars:
+            for var, selected in zip(
+                model.multi_vars[name],
+                model.multi_options[name],
+            ):
+                if selected.key not in frequencies:
+                    continue
+                probability = current[selected.key]
+                if not probability:
+                    raise ValueError(
+                        f"Option can never be selected: {name}.{selected.key}"
+                    )
+                if probability >= 1:
+                    raise ValueError(
+                        f"Option is always selected: {name}.{selected.key}"
+                    )
+                frequency = frequencies[selected.key]
+                ratio = (frequency / (1 - frequency)) / (
+                    probability / (1 - probability)
+                )
+                weights[var] = [
+                    weight if value is None else weight * ratio
+                    for value, weight in zip(model.values[var], weights[var])
+                ]
+            return
+        var = model.index[name]
+        others = sum(
+            probability
+            for key, probability in current.items()
+            if key is not None and key not in frequencies
+        )
+        rest = 1 - current.get(None, 0) - sum(frequencies.values())
+        for value, selected in enumerate(model.values[var]):
+            if selected is None:
+                continue
+            if selected.key in frequencies:
+                if not current[selected.key]:
+                    raise ValueError(
+                        f"Option can never be selected: {name}.{selected.key}"
+                    )
+                weights[var][value] *= frequencies[selected.key] / current[selected.key]
+            elif others:
+                if rest <= 0:
+                    raise ValueError(
+                        f"Target frequencies for {name} leave no room for its other options"
+                    )
+                weights[var][value] *= rest / others
+
+    @staticmethod
+    def _keyed_marginals(model, marginals):
+        keyed = {}
+        for var, (name, values, probabilities) in enumerate(
+            zip(model.names, model.values, marginals)
+        ):
+            if var in model.multi_owner:
+                name = model.multi_owner[var]
+                selected = next(value for value in values if value is not None)
+                keyed.setdefault(name, {})[selected.key] = sum(
+                    probability
+                    for value, probability in zip(values, probabilities)
+                    if value is not None
+                )
+                continue
+            keyed[name] = {}
+            for selected, probability in zip(values, probabilities):
+                key = None if selected is None else selected.key
+                keyed[name][key] = keyed[name].get(key, 0) + probability
+        return keyed
+
+    def _set_weights(self, model, weights):
+        for name, variables in model.multi_vars.items():
+            self.dimensions[name] = tuple(
+                replace(
+                    selected,
+                    weight=next(
+                        weight
+                        for value, weight in zip(model.values[var], weights[var])
+                        if value is not None
+                    ),
+                )
+                for var, selected in zip(variables, model.multi_options[name])
+            )
+        for var, (name, values, new_weights) in enumerate(
+            zip(model.names, model.values, weights)
+        ):
+            if var in model.multi_owner:
+                continue
+            updated = iter(
+                replace(selected, weight=weight)
+                for selected, weight in zip(values, new_weights)
+                if selected is not None
+            )
             if name in self.dimensions:
-                states = self._expand_states(states, self.dimensions[name], name)
+                self.dimensions[name] = tuple(updated)
+            else:
+                self.conditional_dimensions[name] = [
+                    replace(
+                        branch,
+                        options=tuple(next(updated) for _option in branch.options),
+                    )
+                    for branch in self.conditional_dimensions[name]
+                ]
+        self._changed()
+
+    def count(self):
+        """Return the number of valid scenes without enumerating them."""
+        return self._compile("count").total
+
+    def total_weight(self):
+        """Return the summed weight of all valid scenes without enumerating them."""
+        return self._compile("weight").total
+
+    def scene_at(self, index):
+        """Return the valid scene at ``index`` in ``range(count())``.
+
+        Scenes are ordered by the option chosen in each dimension, in prompt
+        order, so an index stays valid while the program is unchanged.
+        """
+        self._validate_elements()
+        ranking = self._compile("ranking")
+        if not 0 <= index < ranking.total:
+            raise IndexError(f"Scene index out of range: {index}")
+        return self._scene(ranking.unrank(index))
+
+    def index_of(self, scene):
+        """Return the index of a valid scene, the inverse of scene_at()."""
+        self._validate_elements()
+        assignment = self._assignment(scene.selection)
+        index = None
+        if assignment is not None:
+            index = self._compile("ranking").rank(assignment)
+        if index is None:
+            raise ValueError(f"Scene is not a valid combination of {self.name}")
+        return index
+
+    def iter_scenes(self, order="index"):
+        """Yield every valid scene lazily.
+
+        ``order="index"`` follows scene_at() order.  ``order="weight"`` yields
+        the heaviest scenes first with a best-first search over max-product
+        elimination tables, which know the best weight reachable from every
+        partial scene, so only the branches leading to the next scene are
+        expanded.
+        """
+        self._validate_elements()
+        if order not in {"index", "weight"}:
+            raise ValueError("order must be 'index' or 'weight'")
+        if order == "index":
+            assignments = self._compile("ranking").assignments()
+        else:
+            assignments = self._compile("best").best_first()
+        return (self._scene(assignment) for assignment in assignments)
+
+    def top_k(self, k):
+        """Return the ``k`` heaviest valid scenes as a SceneBatch, heaviest first."""
+        self._validate_elements()
+        if k < 0:
+            raise ValueError("k must not be negative")
+        return self._batch(list(islice(self._compile("best").best_first(), k)))
+
+    def _scene(self, assignment):
+        return Scene(self._compile("model").selection(assignment), tuple(self.elements))
+
+    def _assignment(self, selection):
+        """Translate a selection into option indices, or None if it cannot match."""
+        model = self._compile("model")
+        if isinstance(selection, SelectionView) and selection._model is model:
+            return selection._assignment
+        if any(
+            name not in model.index and name not in model.multi_vars
+            for name in selection
+        ):
+            return None
+        assignment = []
+        for position, name in enumerate(model.names):
+            owner = model.multi_owner.get(position)
+            if owner is None:
+                value = model.value_index(position, selection.get(name), assignment)
             else:
-                states = self._expand_conditional_states(states, name)
+                value = model.multi_value(position, selection.get(owner), assignment)
+            if value is None:
+                return None
+            assignment.append(value)
+        return tuple(assignment)
+
+    def neighbors(self, scene, k=1):
+        """Return every valid scene that redraws at most ``k`` dimensions of ``scene``.
+
+        Each group of ``k`` dimensions in the scene is redrawn with the rest
+        fixed, re-resolving the conditional dimensions that depend on it.
+        Only the options of the redrawn dimensions are visited.
+        """
+        self._validate_elements()
+        model = self._compile("model")
+        assignment = self._valid_assignment(scene)
+        return self._batch(list(_neighbors(model, assignment, k)))
+
+    def grid(self, vary, fix=None):
+        """Yield every valid scene that changes only the dimensions in ``vary``.
+
+        The other dimensions keep their options from ``fix``, or from the
+        heaviest scene when ``fix`` is None.  Combinations follow the order of
+        ``vary``, with its last dimension changing fastest.  A conditional
+        dimension whose trigger changes keeps the option of ``fix`` when it
+        still can, and otherwise takes its heaviest valid option.  Scenes are
+        built one at a time, so the first one is ready at once.
+        """
+        self._validate_elements()
+        model = self._compile("model")
+        if fix is None:
+            assignment = next(self._compile("best").best_first(), None)
+            if assignment is None:
+                self._raise_no_combinations()
+        else:
+            assignment = self._valid_assignment(fix)
+        variables = []
+        for name in vary:
+            if name in model.multi_vars:
+                raise ValueError(f"Cannot vary a multi-select dimension: {name}")
+            if name not in model.index:
+                raise KeyError(f"Unknown dimension: {name}")
+            variables.append(model.index[name])
+        return (
+            self._scene(row) for row in _grid(model, assignment, tuple(variables))
+        )
+
+    def _valid_assignment(self, scene):
+        assignment = self._assignment(scene.selection)
+        if assignment is None or not _satisfied(
+            assignment,
+            self._compile("model").constraints,
+        ):
+            raise ValueError(f"Scene is not a valid combination of {self.name}")
+        return list(assignment)
+
+    def _validate_elements(self):
+        if self.elements and self.elements[-1][0] == "break":
+            raise ValueError("break_() must be followed by prompt content")
+
+    def fingerprint(self):
+        """Return a hash of everything that affects the compiled tables.
+
+        Programs with the same dimensions, options, weights, tags, rules and
+        elements share one fingerprint, whatever their name, so they also
+        share compiled tables through the process-wide cache.
+        """
+        return self._compile("fingerprint")
+
+    def _compile(self, kind):
+        """Return a compiled table, reused until the program changes.
+
+        Tables that hold only option indices and weights are also looked up
+        in the process-wide cache by fingerprint, so rebuilding an unchanged
+        program skips enumeration and elimination.  The model refers to this
+        program's own Option and Rule objects and is always built locally.
+        """
+        compiled = self._compiled.get(kind)
+        if compiled is None:
+            if kind in {"fingerprint", "model", "plan", "batch_plan"}:
+                compiled = getattr(self, f"_compile_{kind}")()
+            else:
+                key = (
+                    f"{_SOURCE_HASH}-{self.fingerprint()}-{kind}-{self.max_states}"
+                )
+                compiled = _cached(key)
+                if compiled is None:
+                    compiled = getattr(self, f"_compile_{kind}")()
+                    _store(key, compiled)
+            self._compiled[kind] = compiled
+        return compiled
+
+    def _changed(self):
+        self._compiled.clear()
+
+    def _copy(self):
+        """Return an independent program that reuses the compiled tables.
+
+        Options, rules and tables are immutable and shared; the model and the
+        plans refer to this program and are rebuilt by the copy on demand.
+        """
+        program = PromptProgram(
+            self.name,
+            max_states=self.max_states,
+            time_limit=self.time_limit,
+        )
+        program.dimensions = dict(self.dimensions)
+        program.conditional_dimensions = {
+            name: list(branches)
+            for name, branches in self.conditional_dimensions.items()
+        }
+        program.multi_select = dict(self.multi_select)
+        program.elements = list(self.elements)
+        program.block_names = set(self.block_names)
+        program.rules = list(self.rules)
+        program._compiled = {
+            kind: compiled
+            for kind, compiled in self._compiled.items()
+            if kind not in {"model", "plan", "batch_plan"}
+        }
+        return program
+
+    def _compile_fingerprint(self):
+        structure = [
+            self.elements,
+            sorted(self.dimensions.items()),
+            sorted(self.conditional_dimensions.items()),
+            sorted(self.multi_select.items()),
+            self.rules,
+        ]
+        encoded = json.dumps(_fingerprint_data(structure), separators=(",", ":"))
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def _compile_model(self):
+        return _Model(self)
+
+    def _compile_plan(self):
+        """Pick the engine used by engine="auto" from cheap size estimates.
+
+        Small groups of dimensions are enumerated.  Otherwise a pilot run of
+        independent draws estimates the fraction of combinations that pass
+        the rules; rejection sampling is used when it is high enough, then
+        the sequential engine when its tables fit in max_states, and the
+        gibbs engine as the last resort.  When rules pin two dimensions to
+        each other, the gibbs chain could never leave that pair of options,
+        so rejection sampling is used instead; it falls back to the exact
+        engines, which raise the max_states error rather than drawing from
+        the wrong distribution.
+        """
+        model = self._compile("model")
+        # Multi-select dimensions are left to the engines that support them.
+        multi = bool(model.multi_vars)
+        enumerated = sum(
+            prod(model.sizes[var] for var in component)
+            for component in model.components()
+        )
+        if not multi and enumerated <= 10_000:
+            return "enumerate"
+        rejection = self._compile("rejection")
+        if rejection.rate >= 0.1:
+            return "rejection"
+        if multi or self._sequential_fits(model):
+            return "sequential"
+        if _locked_pair(model):
+            return "rejection"
+        return "gibbs"
+
+    def _compile_batch_plan(self):
+        """Pick the engine used by synth_many() with engine="auto".
+
+        With NumPy the sequential engine draws a whole batch in one pass,
+        which beats drawing scenes one by one from the enumerated or
+        rejection engines, so it is preferred whenever its tables fit.
+        """
+        plan = self._compile("plan")
+        if numpy is None or plan in {"sequential", "gibbs"}:
+            return plan
+        if self._sequential_fits(self._compile("model")):
+            return "sequential"
+        return plan
+
+    def _sequential_fits(self, model):
+        scopes = [scope for scope, _table in model.constraints]
+        order = _elimination_order(model.sizes, scopes)
+        states = _elimination_states(model.sizes, scopes, order)
+        return self.max_states is None or states <= self.max_states
+
+    def _compile_count(self):
+        model = self._compile("model")
+        return _Elimination(
+            model,
+            [(1,) * size for size in model.sizes],
+            budget=self._budget(),
+        )
+
+    def _compile_weight(self):
+        model = self._compile("model")
+        return _Elimination(model, model.weights(), budget=self._budget())
+
+    def _compile_best(self):
+        model = self._compile("model")
+        return _Elimination(model, model.weights(), reduce=max, budget=self._budget())
+
+    def _compile_ranking(self):
+        model = self._compile("model")
+        # Eliminating in reverse prompt order ranks scenes in prompt order.
+        return _Elimination(
+            model,
+            [(1,) * size for size in model.sizes],
+            order=reversed(range(len(model.names))),
+            budget=self._budget(),
+        )
+
+    def _compile_gibbs(self):
+        self._require_single_select("gibbs")
+        return _GibbsSampler(self._compile("model"), self._budget())
+
+    def _compile_rejection(self):
+        return _RejectionSampler(self._compile("model"))
+
+    def _compile_vectorized(self):
+        return _VectorSampler(
+            self._compile("sequential"),
+            self._compile("model").sizes,
+        )
+
+    def _compile_sequential(self):
+        sampler = self._compile("weight")
+        if not sampler.total:
+            self._raise_no_combinations()
+        return sampler
+
+    def _compile_enumerate(self):
+        """Enumerate every independent group of dimensions on its own.
+
+        Dimensions that share no rule or branch trigger are sampled
+        independently, so their valid selections are stored per group and
+        combined at draw time instead of being multiplied together.
+        """
+        # Building the model validates conditional branches the same way as
+        # the sequential engine, whatever the expansion order.
+        model = self._compile("model")
+        self._require_single_select("enumerate")
+        budget = self._budget()
+        tables = []
+        for component in model.components():
+            candidates, weights = self._enumerate_component(model, component, budget)
+            if not candidates:
+                self._raise_no_combinations()
+            tables.append((component, candidates, list(accumulate(weights))))
+        return tables
+
+    def _require_single_select(self, engine):
+        if self.multi_select:
+            raise ValueError(
+                f"The {engine} engine does not support multi-select dimensions"
+            )
 
-        valid_states = [
-            (selection, weight)
-            for selection, weight in states
-            if all(rule.accepts(selection) for rule in self.rules)
+    def _enumerate_component(self, model, component, budget):
+        weights = model.weights()
+        order, checks = self._expansion_plan([model.names[var] for var in component])
+        slots = {}
+        # A partial state is a tuple of value indices in expansion order.
+        states = [((), 1.0)]
+        for name in order:
+            var = model.index[name]
+            budget.reserve(len(states) * model.sizes[var])
+            budget.check()
+            if name in self.dimensions:
+                states = self._expand_states(
+                    states,
+                    range(model.sizes[var]),
+                    weights[var],
+                )
+            else:
+                states = self._expand_conditional_states(
+                    states,
+                    model,
+                    var,
+                    slots,
+                    weights[var],
+                )
+            slots[name] = len(slots)
+            if checks[name]:
+                rules = [
+                    (
+                        slots[rule.trigger.dimension],
+                        slots[rule.target.dimension],
+                        model.rule_masks[rule],
+                    )
+                    for rule in checks[name]
+                ]
+                states = [
+                    (state, weight)
+                    for state, weight in states
+                    if all(
+                        allowed[state[trigger]] >> state[target] & 1
+                        for trigger, target, allowed in rules
+                    )
+                ]
+
+        prompt_order = [slots[model.names[var]] for var in component]
+        candidates = [
+            tuple(state[slot] for slot in prompt_order)
+            for state, _weight in states
         ]
-        candidates = [selection for selection, _weight in valid_states]
-        weights = [weight for _selection, weight in valid_states]
+        return candidates, [weight for _state, weight in states]
+
+    def _expansion_plan(self, names):
+        """Order dimensions so rules can prune partial selections early.
+
+        Returns the expansion order of ``names`` and, for every dimension, the
+        rules that become checkable once it has been expanded.  A conditional
+        dimension always follows the dimensions its branch triggers depend on.
+        """
+        position = {
+            name: index
+            for index, name in enumerate(
+                name
+                for element_type, name in self.elements
+                if element_type == "dimension"
+            )
+        }
+        requires = {
+            name: {
+                branch.trigger.dimension
+                for branch in self.conditional_dimensions.get(name, ())
+                if position[branch.trigger.dimension] < position[name]
+            }
+            for name in names
+        }
+        rules_by_dimension = {name: [] for name in names}
+        for rule in self.rules:
+            if rule.trigger.dimension not in rules_by_dimension:
+                continue
+            rules_by_dimension[rule.trigger.dimension].append(rule)
+            if rule.target.dimension != rule.trigger.dimension:
+                rules_by_dimension[rule.target.dimension].append(rule)
+
+        expanded = set()
+        order = []
+        checks = {}
+
+        def checkable(name):
+            return [
+                rule
+                for rule in rules_by_dimension[name]
+                if {rule.trigger.dimension, rule.target.dimension} <= expanded | {name}
+            ]
 
-        if not candidates:
-            rules = "\n".join(f"- {rule.describe()}" for rule in self.rules)
-            raise ValueError(f"No valid prompt combinations for {self.name}:\n{rules}")
+        def priority(name):
+            return (
+                len(checkable(name)),
+                len(rules_by_dimension[name]),
+                -self._option_count(name),
+                -position[name],
+            )
 
-        selected = Random(seed).choices(candidates, weights=weights, k=1)[0]
-        return Scene(selected, tuple(self.elements))
+        while len(order) < len(names):
+            name = max(
+                (
+                    name
+                    for name in names
+                    if name not in expanded and requires[name] <= expanded
+                ),
+                key=priority,
+            )
+            checks[name] = checkable(name)
+            expanded.add(name)
+            order.append(name)
+        return order, checks
 
-    def _add_dimension(self, name, options, *, break_before=False):
+    def _option_count(self, name):
+        if name in self.dimensions:
+            return len(self.dimensions[name])
+        return 1 + sum(
+            len(branch.options) for branch in self.conditional_dimensions[name]
+        )
+
+    def _conflict(self, model):
+        """Return a minimal set of rules without valid scenes, or ()."""
+        structure = model.branch_constraints + model.count_constraints
+        rules = model.rule_constraints
+        ones = [(1,) * size for size in model.sizes]
+        budget = self._budget()
+
+        def satisfiable(kept):
+            constraints = structure + [
+                constraint for index in kept for constraint in rules[index]
+            ]
+            if _arc_consistency(model.sizes, constraints) is None:
+                return False
+            return bool(_Elimination(model, ones, constraints, budget=budget).total)
+
+        if self._compile("count").total:
+            return ()
+        kept = list(range(len(rules)))
+        # Branches and selection counts alone always leave a valid scene, so
+        # a rule must remain.
+        for index in list(kept):
+            trial = [other for other in kept if other != index]
+            if not satisfiable(trial):
+                kept = trial
+        return tuple(self.rules[index] for index in kept)
+
+    def _raise_no_combinations(self):
+        rules = "\n".join(
+            f"- {rule.describe()}"
+            for rule in self._conflict(self._compile("model"))
+        )
+        raise ValueError(f"No valid prompt combinations for {self.name}:\n{rules}")
+
+    def _add_dimension(
+        self,
+        name,
+        options,
+        *,
+        break_before=False,
+        minimum=None,
+        maximum=None,
+    ):
         if name in self.dimensions or name in self.conditional_dimensions:
             raise ValueError(f"Dimension already exists: {name}")
         _validate_dimension(name, options)
+        if minimum is not None or maximum is not None:
+            self.multi_select[name] = _selection_bounds(
+                name,
+                options,
+                minimum,
+                maximum,
+            )
         if break_before:
             self._add_break()
         self.dimensions[name] = tuple(options)
         self.elements.append(("dimension", name))
+        self._changed()
 
     def _add_conditional_dimension(
         self,
@@ -404,6 +1921,11 @@ class PromptProgram:
         if name in self.dimensions:
             raise ValueError(f"Dimension already exists: {name}")
         _validate_dimension(name, options)
+        if trigger.dimension in self.multi_select:
+            raise ValueError(
+                "A multi-select dimension cannot trigger a conditional "
+                f"dimension: {trigger.dimension}"
+            )
         if name not in self.conditional_dimensions:
             if break_before:
                 raise ValueError(
@@ -414,40 +1936,31 @@ class PromptProgram:
         self.conditional_dimensions[name].append(
             ConditionalBranch(trigger, tuple(options))
         )
+        self._changed()
 
     @staticmethod
-    def _expand_states(states, options, name):
+    def _expand_states(states, values, weights):
         return [
-            (
-                {**selection, name: selected},
-                weight * selected.weight,
-            )
-            for selection, weight in states
-            for selected in options
+            (state + (value,), weight * weights[value])
+            for state, weight in states
+            for value in values
         ]
 
-    def _expand_conditional_states(self, states, name):
+    @staticmethod
+    def _expand_conditional_states(states, model, var, slots, weights):
+        # Branches are resolved once per combination of trigger options when
+        # the model is built, so each state needs one table lookup.
+        triggers, lookup = model.branch_values[var]
+        positions = [slots[model.names[trigger]] for trigger in triggers]
         expanded = []
-        for selection, weight in states:
-            matching = [
-                branch
-                for branch in self.conditional_dimensions[name]
-                if branch.trigger.matches(selection)
-            ]
-            if len(matching) > 1:
+        for state, weight in states:
+            values = lookup[tuple(state[position] for position in positions)]
+            if values is None:
                 raise ValueError(
-                    f"Multiple conditional branches matched dimension: {name}"
+                    f"Multiple conditional branches matched dimension: {model.names[var]}"
                 )
-            if not matching:
-                expanded.append((selection, weight))
-                continue
-            expanded.extend(
-                self._expand_states(
-                    [(selection, weight)],
-                    matching[0].options,
-                    name,
-                )
-            )
+            for value in values:
+                expanded.append((state + (value,), weight * weights[value]))
         return expanded
 
     def _add_fixed(self, value):
@@ -456,9 +1969,11 @@ class PromptProgram:
         for fragment in fragments:
             if fragment:
                 self.elements.append(("fixed", fragment))
+        self._changed()
 
     def _add_break(self):
         self.elements.append(("break", None))
+        self._changed()
 
     def _condition(self, dimension, key, keys, tag, tags, match):
         if (
@@ -508,12 +2023,1777 @@ class PromptProgram:
 
     def _add_rule(self, rule):
         self.rules.append(rule)
+        self._changed()
 
     @staticmethod
     def _program_scope(dimension):
         return dimension.removeprefix("program.")
 
 
+class _Model:
+    """Constraint network built from the dimensions and rules of a program.
+
+    Every dimension becomes a variable whose values index its options.  A
+    conditional dimension has the extra value 0 (``None``) for "absent", and
+    its branches and the program rules become hard constraints.  Constraints
+    are ``(scope, table)`` pairs mapping allowed value tuples to 1.
+
+    A multi-select dimension becomes one variable per option, named
+    ``name[key]``, whose values pair "selected or not" with the number of
+    options selected so far.  Neighbouring options are linked by a constraint
+    that adds one to the count, so the tables grow with the number of
+    options times ``max`` instead of with the number of subsets.
+    """
+
+    def __init__(self, program):
+        # Scenes keep the model, so work done on them uses the program's
+        # current limits through it.
+        self.budget = program._budget
+        names = []
+        self.values = []
+        # Running count of selected options, by value, for multi-select
+        # variables.
+        self.counts = {}
+        self.count_constraints = []
+        self.multi_vars = {}
+        self.multi_options = {}
+        self.multi_owner = {}
+        for element_type, name in program.elements:
+            if element_type != "dimension":
+                continue
+            if name in program.multi_select:
+                self._add_multi_select(
+                    names,
+                    name,
+                    program.dimensions[name],
+                    program.multi_select[name],
+                )
+                continue
+            names.append(name)
+            if name in program.dimensions:
+                self.values.append(tuple(program.dimensions[name]))
+            else:
+                self.values.append(
+                    (None,)
+                    + tuple(
+                        selected
+                        for branch in program.conditional_dimensions[name]
+                        for selected in branch.options
+                    )
+                )
+        self.names = tuple(names)
+        self.index = {name: position for position, name in enumerate(self.names)}
+        self.sizes = tuple(len(values) for values in self.values)
+        # Tags are interned into bits, so a condition is checked against an
+        # option with a key lookup and two integer operations.
+        self.tag_bits = {}
+        self.tag_masks = [
+            tuple(
+                0 if selected is None else self._tag_mask(selected.tags)
+                for selected in values
+            )
+            for values in self.values
+        ]
+        # For every rule, the target values allowed by each trigger value as
+        # a bit mask.
+        self.rule_masks = {}
+
+        self.branches = {}
+        self.branch_values = {}
+        self.branch_constraints = []
+        overlaps = []
+        for name in self.names:
+            if name in program.conditional_dimensions:
+                constraint, overlap = self._branch_constraint(
+                    name,
+                    program.conditional_dimensions[name],
+                )
+                self.branch_constraints.append(constraint)
+                if overlap[1]:
+                    overlaps.append((name, overlap))
+        # A rule on a multi-select dimension becomes one constraint per
+        # option, so every rule keeps a list.
+        self.rule_constraints = [self._rule_constraints(rule) for rule in program.rules]
+        self.constraints = (
+            self.branch_constraints
+            + self.count_constraints
+            + [
+                constraint
+                for constraints in self.rule_constraints
+                for constraint in constraints
+            ]
+        )
+        for name, overlap in overlaps:
+            self._check_overlap(name, overlap)
+
+        # Changing a trigger can switch the conditional dimensions that depend
+        # on it on or off, so they are resampled with it.
+        self.dependents = [set() for _size in self.sizes]
+        for var, branches in self.branches.items():
+            for branch, _values in branches:
+                self.dependents[self.index[branch.trigger.dimension]].add(var)
+        self.watching = [[] for _size in self.sizes]
+        for position, (scope, _table) in enumerate(self.constraints):
+            for var in set(scope):
+                self.watching[var].append(position)
+
+    def _add_multi_select(self, names, name, options, bounds):
+        minimum, maximum = bounds
+        variables = []
+        for position, selected in enumerate(options):
+            var = len(self.values)
+            later = len(options) - position - 1
+            values = []
+            counts = []
+            for selected_count in range(min(position + 1, maximum) + 1):
+                # Counts that cannot reach ``minimum`` any more are dropped.
+                if selected_count + later < minimum:
+                    continue
+                if selected_count <= position:
+                    values.append(None)
+                    counts.append(selected_count)
+                if selected_count:
+                    values.append(selected)
+                    counts.append(selected_count)
+            names.append(f"{name}[{selected.key}]")
+            self.values.append(tuple(values))
+            self.counts[var] = tuple(counts)
+            self.multi_owner[var] = name
+            if variables:
+                previous = variables[-1]
+                self.count_constraints.append(
+                    (
+                        (previous, var),
+                        {
+                            (before, value): 1
+                            for before, before_count in enumerate(
+                                self.counts[previous]
+                            )
+                            for value, count in enumerate(counts)
+                            if count == before_count + (values[value] is not None)
+                        },
+                    )
+                )
+            else:
+                self.count_constraints.append(
+                    (
+                        (var,),
+                        {
+                            (value,): 1
+                            for value, count in enumerate(counts)
+                            if count == (values[value] is not None)
+                        },
+                    )
+                )
+            variables.append(var)
+        self.multi_vars[name] = tuple(variables)
+        self.multi_options[name] = tuple(options)
+
+    def multi_selection(self, name, assignment):
+        """Return the options of a multi-select dimension chosen by ``assignment``."""
+        return tuple(
+            self.values[var][assignment[var]]
+            for var in self.multi_vars[name]
+            if self.values[var][assignment[var]] is not None
+        )
+
+    def weights(self):
+        """Return the option weight of every value of every variable."""
+        return [self.value_weights(var) for var in range(len(self.values))]
+
+    def value_weights(self, var):
+        return tuple(
+            1.0 if value is None else value.weight for value in self.values[var]
+        )
+
+    def block(self, variables):
+        """Return ``variables`` with every conditional dimension depending on them."""
+        block = set(variables)
+        pending = list(block)
+        while pending:
+            for dependent in self.dependents[pending.pop()]:
+                if dependent not in block:
+                    block.add(dependent)
+                    pending.append(dependent)
+        return tuple(sorted(block))
+
+    def checks(self, block):
+        """Return the constraints that involve a variable of ``block``."""
+        positions = sorted(
+            {position for var in block for position in self.watching[var]}
+        )
+        return [self.constraints[position] for position in positions]
+
+    def selection(self, assignment):
+        return SelectionView(self, tuple(assignment))
+
+    def components(self):
+        """Group variables connected by a rule or a branch trigger.
+
+        Returns tuples of variables in prompt order; groups never share a
+        constraint, so they can be enumerated and sampled independently.
+        """
+        parent = list(range(len(self.names)))
+
+        def root(var):
+            while parent[var] != var:
+                parent[var] = parent[parent[var]]
+                var = parent[var]
+            return var
+
+        for scope, _table in self.constraints:
+            for var in scope[1:]:
+                parent[root(var)] = root(scope[0])
+        groups = {}
+        for var in range(len(self.names)):
+            groups.setdefault(root(var), []).append(var)
+        return [tuple(group) for group in groups.values()]
+
+    def value_index(self, position, selected, assignment):
+        """Return the value index of an option, or None if it is not a value.
+
+        ``assignment`` holds the values of the earlier dimensions; it decides
+        which branch an option reused by several branches belongs to.
+        """
+        matches = [
+            value
+            for value, candidate in enumerate(self.values[position])
+            if candidate == selected
+        ]
+        if len(matches) > 1 and position in self.branch_values:
+            triggers, lookup = self.branch_values[position]
+            active = lookup[tuple(assignment[trigger] for trigger in triggers)] or ()
+            matches = [value for value in matches if value in active]
+        return matches[0] if matches else None
+
+    def multi_value(self, position, chosen, assignment):
+        """Return the value of a multi-select variable, or None if it is not one.
+
+        ``chosen`` is the tuple of selected options of the whole dimension.
+        """
+        name = self.multi_owner[position]
+        variables = self.multi_vars[name]
+        options = self.multi_options[name]
+        if not isinstance(chosen, tuple):
+            return None
+        if any(selected not in options for selected in chosen):
+            return None
+        selected = options[variables.index(position)] in chosen
+        count = int(selected)
+        if position != variables[0]:
+            count += self.counts[position - 1][assignment[position - 1]]
+        for value, candidate in enumerate(self.values[position]):
+            if (
+                (candidate is not None) == selected
+                and self.counts[position][value] == count
+            ):
+                return value
+        return None
+
+    def _tag_mask(self, tags):
+        mask = 0
+        for tag in tags:
+            mask |= self.tag_bits.setdefault(tag, 1 << len(self.tag_bits))
+        return mask
+
+    def _matching(self, condition, var=None):
+        """Return the values of the condition's dimension that it matches."""
+        if var is None:
+            var = self.index[condition.dimension]
+        mask = self._tag_mask(condition.tags)
+        required = mask if condition.match == "all" else 0
+        any_of = mask if condition.match == "any" else 0
+        return frozenset(
+            value
+            for value, (selected, tags) in enumerate(
+                zip(self.values[var], self.tag_masks[var])
+            )
+            if selected is not None
+            and (not condition.keys or selected.key in condition.keys)
+            and tags & required == required
+            and (not any_of or tags & any_of)
+        )
+
+    def _rule_constraints(self, rule):
+        """Return the constraints of a rule.
+
+        A rule triggered by a multi-select dimension fires when any selected
+        option matches, so it holds when it holds for each option on its own.
+        On a multi-select target, ``require`` lets only matching options be
+        selected and ``forbid`` lets none of them be selected.
+        """
+        multi = (rule.trigger.dimension, rule.target.dimension)
+        if not any(name in self.multi_vars for name in multi):
+            return [self._rule_constraint(rule)]
+        required = rule.mode == "require"
+        constraints = []
+        for trigger in self._condition_vars(rule.trigger):
+            triggers = self._matching(rule.trigger, trigger)
+            if not triggers:
+                continue
+            for target in self._condition_vars(rule.target):
+                targets = self._matching(rule.target, target)
+                optional = target in self.multi_owner
+
+                def accepts(trigger_value, target_value):
+                    if trigger_value not in triggers:
+                        return True
+                    if optional and self.values[target][target_value] is None:
+                        return True
+                    return (target_value in targets) == required
+
+                scope, table = self._pair_constraint(trigger, target, accepts)
+                if len(table) < prod(self.sizes[var] for var in scope):
+                    constraints.append((scope, table))
+        return constraints
+
+    def _condition_vars(self, condition):
+        if condition.dimension in self.multi_vars:
+            return self.multi_vars[condition.dimension]
+        return (self.index[condition.dimension],)
+
+    def _rule_constraint(self, rule):
+        trigger = self.index[rule.trigger.dimension]
+        target = self.index[rule.target.dimension]
+        triggers = self._matching(rule.trigger)
+        targets = self._matching(rule.target)
+        required = rule.mode == "require"
+
+        def accepts(trigger_value, target_value):
+            if trigger_value not in triggers:
+                return True
+            return (target_value in targets) == required
+
+        self.rule_masks[rule] = tuple(
+            sum(
+                1 << value
+                for value in range(self.sizes[target])
+                if accepts(trigger_value, value)
+            )
+            for trigger_value in range(self.sizes[trigger])
+        )
+        return self._pair_constraint(trigger, target, accepts)
+
+    def _pair_constraint(self, trigger, target, accepts):
+        if trigger == target:
+            return (
+                (trigger,),
+                {
+                    (value,): 1
+                    for value in range(self.sizes[trigger])
+                    if accepts(value, value)
+                },
+            )
+        scope = tuple(sorted((trigger, target)))
+        table = {}
+        for values in product(*(range(self.sizes[var]) for var in scope)):
+            assigned = dict(zip(scope, values))
+            if accepts(assigned[trigger], assigned[target]):
+                table[values] = 1
+        return scope, table
+
+    def _branch_constraint(self, name, branches):
+        position = self.index[name]
+        self.branches[position] = []
+        active = []
+        start = 1
+        for branch in branches:
+            trigger = self.index[branch.trigger.dimension]
+            values = range(start, start + len(branch.options))
+            start += len(branch.options)
+            # Triggers are evaluated while the dimension is expanded, so a
+            # trigger on a later dimension never matches.
+            if trigger < position:
+                self.branches[position].append((branch, values))
+                active.append((trigger, self._matching(branch.trigger), values))
+        triggers = tuple(sorted({trigger for trigger, _matching, _values in active}))
+
+        table = {}
+        overlapping = {}
+        # Values of the dimension for every combination of trigger values,
+        # or None where several branches match.
+        lookup = {}
+        for assigned in product(*(range(self.sizes[var]) for var in triggers)):
+            matched = [
+                values
+                for trigger, accepted, values in active
+                if assigned[triggers.index(trigger)] in accepted
+            ]
+            if len(matched) > 1:
+                overlapping[assigned] = 1
+                lookup[assigned] = None
+            else:
+                lookup[assigned] = tuple(matched[0]) if matched else (0,)
+                for value in lookup[assigned]:
+                    table[assigned + (value,)] = 1
+        self.branch_values[position] = (triggers, lookup)
+        return (triggers + (position,), table), (triggers, overlapping)
+
+    def _check_overlap(self, name, overlap):
+        triggers, _overlapping = overlap
+        if any(self.values[var][0] is None for var in triggers):
+            # A conditional trigger may never reach the overlapping values, so
+            # only fail when some expansion of the branches does.
+            position = self.index[name]
+            reachable = _Elimination(
+                self,
+                [(1,) * size for size in self.sizes],
+                [
+                    constraint
+                    for constraint in self.branch_constraints
+                    if constraint[0][-1] != position
+                ]
+                + [overlap],
+            )
+            if not reachable.total:
+                return
+        raise ValueError(f"Multiple conditional branches matched dimension: {name}")
+
+
+def _locked_pair(model):
+    """Return whether rules pin two dimensions to one pair of their options.
+
+    Once both hold that pair, changing either one alone breaks a rule, so a
+    Gibbs chain that resamples one dimension at a time is stuck there.
+    Conditional dimensions resampled together with their trigger are not
+    affected.
+    """
+    merged = {}
+    for scope, table in model.constraints:
+        if len(set(scope)) != 2:
+            continue
+        if scope in merged:
+            merged[scope] &= table.keys()
+        else:
+            merged[scope] = set(table)
+    for (first, second), allowed in merged.items():
+        if second in model.block((first,)) or first in model.block((second,)):
+            continue
+        forward = {}
+        backward = {}
+        for first_value, second_value in allowed:
+            forward.setdefault(first_value, set()).add(second_value)
+            backward.setdefault(second_value, set()).add(first_value)
+        if any(
+            forward[first_value] == {second_value}
+            and backward[second_value] == {first_value}
+            for first_value, second_value in allowed
+        ):
+            return True
+    return False
+
+
+def _arc_consistency(sizes, constraints, domains=None):
+    """Prune values without support in some constraint; None on a wipe-out.
+
+    ``domains`` holds the values still allowed for every variable, all of
+    them by default; it is narrowed in place.
+    """
+    # Rules on the same pair of dimensions are checked together, so that
+    # values each of them allows on its own can still be pruned.
+    merged = {}
+    for scope, table in constraints:
+        if scope in merged:
+            merged[scope] &= table.keys()
+        else:
+            merged[scope] = set(table)
+    constraints = list(merged.items())
+    if domains is None:
+        domains = [set(range(size)) for size in sizes]
+    watching = [[] for _size in sizes]
+    for index, (scope, _table) in enumerate(constraints):
+        for var in set(scope):
+            watching[var].append(index)
+    pending = list(range(len(constraints)))
+    queued = set(pending)
+    while pending:
+        index = pending.pop()
+        queued.discard(index)
+        scope, table = constraints[index]
+        rows = [
+            values
+            for values in table
+            if all(value in domains[var] for var, value in zip(scope, values))
+        ]
+        for position, var in enumerate(scope):
+            supported = {values[position] for values in rows}
+            if domains[var] <= supported:
+                continue
+            domains[var] &= supported
+            if not domains[var]:
+                return None
+            for other in watching[var]:
+                if other not in queued:
+                    queued.add(other)
+                    pending.append(other)
+    return domains
+
+
+class _Elimination:
+    """Bucket elimination over a model, kept for sequential sampling.
+
+    Variables are eliminated one at a time.  Each bucket stores, for every
+    assignment of its context variables, the values of the eliminated
+    variable with the cumulative weight of their valid completions, so
+    sampling in reverse elimination order draws exactly from the constrained
+    distribution with one binary search per dimension.
+    """
+
+    def __init__(
+        self,
+        model,
+        weights,
+        constraints=None,
+        reduce=sum,
+        order=None,
+        budget=None,
+    ):
+        if constraints is None:
+            constraints = model.constraints
+        factors = [
+            ((var,), {(value,): weight for value, weight in enumerate(values) if weight})
+            for var, values in enumerate(weights)
+        ]
+        factors.extend(constraints)
+        scopes = [scope for scope, _ in factors]
+        if order is None:
+            order = _elimination_order(model.sizes, scopes)
+        self.order = list(order)
+        if budget is not None:
+            budget.reserve(_elimination_states(model.sizes, scopes, self.order))
+        self.buckets = []
+        for var in self.order:
+            if budget is not None:
+                budget.check()
+            bucket = [factor for factor in factors if var in factor[0]]
+            factors = [factor for factor in factors if var not in factor[0]]
+            context, rows, message = _eliminate(var, bucket, model.sizes, reduce)
+            self.buckets.append((var, context, rows))
+            factors.append(message)
+
+        total = 1
+        for _scope, table in factors:
+            total *= table.get((), 0)
+        self.total = total
+        self.size = len(model.sizes)
+        self.sizes = model.sizes
+
+    def marginals(self):
+        """Return the probability of every value of every variable.
+
+        Buckets are visited in sampling order.  The joint probability of a
+        bucket's context is summed out of the bucket that received its
+        message, so one pass covers every variable.
+        """
+        step_of = {var: step for step, (var, _context, _rows) in enumerate(self.buckets)}
+        joints = [None] * len(self.buckets)
+        marginals = [None] * self.size
+        for step in reversed(range(len(self.buckets))):
+            var, context, rows = self.buckets[step]
+            if context:
+                parent = min(step_of[other] for other in context)
+                parent_var, parent_context, _rows = self.buckets[parent]
+                scope = parent_context + (parent_var,)
+                picks = [scope.index(other) for other in context]
+                contexts = {}
+                for assignment, probability in joints[parent].items():
+                    key = tuple(assignment[pick] for pick in picks)
+                    contexts[key] = contexts.get(key, 0) + probability
+            else:
+                contexts = {(): 1.0}
+            joint = {}
+            marginal = [0.0] * self.sizes[var]
+            for assignment, probability in contexts.items():
+                values, cumulative = rows[assignment]
+                previous = 0
+                for value, current in zip(values, cumulative):
+                    share = probability * (current - previous) / cumulative[-1]
+                    previous = current
+                    joint[assignment + (value,)] = share
+                    marginal[value] += share
+            joints[step] = joint
+            marginals[var] = marginal
+        return marginals
+
+    def sample(self, rng):
+        return self.transform(rng.random() for _bucket in self.buckets)
+
+    def transform(self, uniforms):
+        """Map one uniform number per bucket onto an assignment by inverse CDF."""
+        assignment = [None] * self.size
+        for (var, context, rows), uniform in zip(reversed(self.buckets), uniforms):
+            values, cumulative = rows[tuple(assignment[other] for other in context)]
+            assignment[var] = _draw(values, cumulative, uniform)
+        return assignment
+
+    def assignments(self):
+        """Yield every valid assignment in sampling-order lexicographic order."""
+        buckets = list(reversed(self.buckets))
+        assignment = [None] * self.size
+
+        def walk(depth):
+            if not self.total:
+                return
+            if depth == len(buckets):
+                yield tuple(assignment)
+                return
+            var, context, rows = buckets[depth]
+            values, _cumulative = rows[tuple(assignment[other] for other in context)]
+            for value in values:
+                assignment[var] = value
+                yield from walk(depth + 1)
+
+        return walk(0)
+
+    def sample_distinct(self, n, rng):
+        """Draw ``n`` distinct assignments with a stochastic beam search.
+
+        Every prefix carries a Gumbel-perturbed log-probability; children are
+        perturbed so that their maximum equals their parent's value, and the
+        ``n`` best prefixes survive each step.  The final beam is an exact
+        weighted sample without replacement (Kool et al., 2019).
+        """
+        beam = [(0.0, 0.0, (None,) * self.size)]
+        for var, context, rows in reversed(self.buckets):
+            candidates = []
+            for bound, log_probability, assignment in beam:
+                values, cumulative = rows[tuple(assignment[other] for other in context)]
+                children = []
+                before = 0
+                for value, after in zip(values, cumulative):
+                    child = log_probability + log((after - before) / cumulative[-1])
+                    children.append((child + _gumbel(rng), child, value))
+                    before = after
+                top = max(perturbed for perturbed, _child, _value in children)
+                for perturbed, child, value in children:
+                    candidates.append(
+                        (
+                            _truncated_gumbel(bound, top, perturbed),
+                            child,
+                            assignment[:var] + (value,) + assignment[var + 1 :],
+                        )
+                    )
+            beam = heapq.nlargest(n, candidates, key=itemgetter(0))
+        return [assignment for _bound, _log_probability, assignment in beam]
+
+    def best_first(self):
+        """Yield valid assignments from the highest weight down.
+
+        Requires tables built with ``reduce=max``.  A value's bucket weight
+        divided by the best one in its row is the share of the best reachable
+        weight it keeps, so the product over a prefix is exact for its best
+        completion and the first complete assignment popped is the heaviest.
+        """
+        if not self.total:
+            return
+        buckets = list(reversed(self.buckets))
+        tiebreak = count()
+        queue = [(-1.0, next(tiebreak), 0, (None,) * self.size)]
+        while queue:
+            priority, _tiebreak, depth, assignment = heapq.heappop(queue)
+            if depth == len(buckets):
+                yield list(assignment)
+                continue
+            var, context, rows = buckets[depth]
+            values, cumulative = rows[tuple(assignment[other] for other in context)]
+            weights = [
+                after - before for before, after in zip((0,) + cumulative, cumulative)
+            ]
+            best = max(weights)
+            for value, weight in zip(values, weights):
+                child = list(assignment)
+                child[var] = value
+                heapq.heappush(
+                    queue,
+                    (priority * weight / best, next(tiebreak), depth + 1, tuple(child)),
+                )
+
+    def unrank(self, index):
+        """Return the assignment at ``index`` in sampling-order lexicographic order.
+
+        Requires integer weights.  The completions of a prefix extended by a
+        value are the bucket weight of that value times the completions of the
+        prefix divided by the bucket total, so each step is one binary search.
+        """
+        assignment = [None] * self.size
+        completions = self.total
+        for var, context, rows in reversed(self.buckets):
+            values, cumulative = rows[tuple(assignment[other] for other in context)]
+            scale = completions // cumulative[-1]
+            position = bisect(cumulative, index // scale)
+            before = cumulative[position - 1] if position else 0
+            index -= scale * before
+            completions = scale * (cumulative[position] - before)
+            assignment[var] = values[position]
+        return assignment
+
+    def rank(self, assignment):
+        """Return the index of a valid assignment, or None if it is invalid."""
+        index = 0
+        completions = self.total
+        for var, context, rows in reversed(self.buckets):
+            row = rows.get(tuple(assignment[other] for other in context))
+            if row is None:
+                return None
+            values, cumulative = row
+            position = bisect_left(values, assignment[var])
+            if position == len(values) or values[position] != assignment[var]:
+                return None
+            scale = completions // cumulative[-1]
+            before = cumulative[position - 1] if position else 0
+            index += scale * before
+            completions = scale * (cumulative[position] - before)
+        return index
+
+
+class _GibbsSampler:
+    """Markov chain over valid assignments, resampling one block at a time.
+
+    A block is one dimension together with the conditional dimensions whose
+    branches depend on it, so changing a trigger can switch them on or off
+    in the same step.  Only the model's constraint tables are kept, so the
+    memory used does not grow with the number of valid scenes.
+    """
+
+    def __init__(self, model, budget):
+        self.sizes = model.sizes
+        self.weights = model.weights()
+        self.constraints = model.constraints
+
+        self.blocks = []
+        for var in range(len(self.sizes)):
+            block = model.block((var,))
+            budget.reserve(prod(self.sizes[var] for var in block))
+            self.blocks.append((block, model.checks(block)))
+
+    def run(self, n, rng, burn_in, thin, budget):
+        """Return ``n`` assignments of the chain, or None without any valid one."""
+        assignment = self.initial(rng, budget)
+        if assignment is None:
+            return None
+        for _sweep in range(burn_in):
+            budget.check()
+            self.sweep(assignment, rng)
+        rows = []
+        for _index in range(n):
+            for _sweep in range(thin):
+                budget.check()
+                self.sweep(assignment, rng)
+            rows.append(tuple(assignment))
+        return rows
+
+    def initial(self, rng, budget):
+        """Find a valid assignment by randomized search with arc consistency.
+
+        Every choice is followed by pruning the other dimensions, so a choice
+        that leaves some dimension without a valid option is undone at once
+        instead of after the dimensions in between have been tried.  The
+        dimension with the fewest options left is chosen next.
+        """
+        domains = _arc_consistency(self.sizes, self.constraints)
+        stack = []
+        while domains is not None or stack:
+            budget.check()
+            if domains is not None:
+                undecided = [
+                    var for var, domain in enumerate(domains) if len(domain) > 1
+                ]
+                if not undecided:
+                    return [min(domain) for domain in domains]
+                var = min(undecided, key=lambda var: len(domains[var]))
+                candidates = sorted(domains[var])
+                rng.shuffle(candidates)
+                stack.append((domains, var, candidates))
+            parent, var, candidates = stack[-1]
+            if not candidates:
+                stack.pop()
+                domains = None
+                continue
+            domains = [set(domain) for domain in parent]
+            domains[var] = {candidates.pop()}
+            domains = _arc_consistency(self.sizes, self.constraints, domains)
+        return None
+
+    def sweep(self, assignment, rng):
+        for block, checks in self.blocks:
+            choices, weights = _block_choices(
+                block,
+                assignment,
+                self.sizes,
+                self.weights,
+                checks,
+            )
+            # The current values are valid, so there is always a candidate.
+            values = rng.choices(choices, weights=weights, k=1)[0]
+            for var, value in zip(block, values):
+                assignment[var] = value
+
+
+class _RejectionSampler:
+    """Draw every dimension independently and retry until the rules hold.
+
+    A pilot run measures the fraction of draws that pass the rules.  The
+    retry limit follows from it, so that giving up on a program that has
+    valid scenes is very unlikely; callers then fall back to an exact engine.
+    """
+
+    pilot = 1000
+
+    def __init__(self, model):
+        self.values = [tuple(range(size)) for size in model.sizes]
+        self.cumulative = [tuple(accumulate(weights)) for weights in model.weights()]
+        self.constraints = model.constraints
+        rng = Random(0)
+        accepted = sum(
+            _satisfied(self.draw(rng), self.constraints)
+            for _attempt in range(self.pilot)
+        )
+        self.rate = accepted / self.pilot
+        # Laplace's estimate keeps the limit finite when the pilot saw nothing.
+        rate = (accepted + 1) / (self.pilot + 2)
+        self.limit = ceil(log(1e-9) / log1p(-rate))
+
+    def draw(self, rng):
+        return [
+            _draw(values, cumulative, rng.random())
+            for values, cumulative in zip(self.values, self.cumulative)
+        ]
+
+    def sample(self, rng, budget):
+        """Return a valid assignment, or None once the retry limit is reached."""
+        for attempt in range(self.limit):
+            if not attempt % 1024:
+                budget.check()
+            assignment = self.draw(rng)
+            if _satisfied(assignment, self.constraints):
+                return assignment
+        return None
+
+
+class _Budget:
+    """Memory and time limits for building tables or running a sampler."""
+
+    def __init__(self, name, max_states, time_limit):
+        self.name = name
+        self.max_states = max_states
+        self.time_limit = time_limit
+        self.deadline = None if time_limit is None else monotonic() + time_limit
+
+    def reserve(self, states):
+        if self.max_states is not None and states > self.max_states:
+            raise ValueError(
+                f"{self.name} needs {states} states, "
+                f"more than max_states={self.max_states}"
+            )
+
+    def check(self):
+        if self.deadline is not None and monotonic() >= self.deadline:
+            raise TimeoutError(
+                f"{self.name} did not finish within {self.time_limit} seconds"
+            )
+
+
+def _mutate(model, assignment, k, rng, budget):
+    units = _changeable(model, assignment, k)
+    rng.shuffle(units)
+    # Dimensions that the rules pin to their current options are passed
+    # over, so the variation only stays the same when nothing can change.
+    movable = []
+    for unit in units:
+        if len(movable) == k:
+            break
+        if _can_change(model, model.block(unit), assignment):
+            movable.append(unit)
+    chosen = movable + [unit for unit in units if unit not in movable][
+        : k - len(movable)
+    ]
+    if not movable and k > 1:
+        # Pinned dimensions may still change together, but only through a
+        # rule that links them, so only linked groups are tried.
+        group = _linked_change(model, units, k, assignment, rng, budget)
+        if group is not None:
+            chosen = group + [unit for unit in chosen if unit not in group][
+                : k - len(group)
+            ]
+    block = model.block(var for unit in chosen for var in unit)
+    weights = {var: model.value_weights(var) for var in block}
+    current = tuple(assignment[var] for var in block)
+    if any(var in model.multi_owner for var in block):
+        # Too many subsets to list; draw from the block's own elimination
+        # tables until the result differs, if anything else is valid.
+        sampler = _block_elimination(model, block, assignment)
+        if _can_change(model, block, assignment):
+            values = current
+            while values == current:
+                values = tuple(sampler.sample(rng))
+            for var, value in zip(block, values):
+                assignment[var] = value
+        return assignment
+    choices, choice_weights = _block_choices(
+        block,
+        assignment,
+        model.sizes,
+        weights,
+        model.checks(block),
+    )
+    others = [
+        (values, weight)
+        for values, weight in zip(choices, choice_weights)
+        if values != current
+    ]
+    if others:
+        values = rng.choices(
+            [values for values, _weight in others],
+            weights=[weight for _values, weight in others],
+            k=1,
+        )[0]
+        for var, value in zip(block, values):
+            assignment[var] = value
+    return assignment
+
+
+def _can_change(model, block, assignment):
+    """Return whether ``block`` has another valid value given the rest."""
+    if any(var in model.multi_owner for var in block):
+        sampler = _block_elimination(model, block, assignment)
+        return len(list(islice(sampler.assignments(), 2))) > 1
+    choices, _weights = _block_choices(
+        block,
+        assignment,
+        model.sizes,
+        {var: model.value_weights(var) for var in block},
+        model.checks(block),
+    )
+    return len(choices) > 1
+
+
+def _neighbors(model, assignment, k):
+    """Yield every other valid assignment that redraws at most ``k`` dimensions."""
+    seen = {tuple(assignment)}
+    for chosen in combinations(_changeable(model, assignment, k), k):
+        block = model.block(var for unit in chosen for var in unit)
+        if any(var in model.multi_owner for var in block):
+            choices = _block_elimination(model, block, assignment).assignments()
+        else:
+            choices, _weights = _block_choices(
+                block,
+                assignment,
+                model.sizes,
+                {var: model.value_weights(var) for var in block},
+                model.checks(block),
+            )
+        for values in choices:
+            neighbor = list(assignment)
+            for var, value in zip(block, values):
+                neighbor[var] = value
+            if tuple(neighbor) not in seen:
+                seen.add(tuple(neighbor))
+                yield neighbor
+
+
+def _grid(model, assignment, variables):
+    """Yield the valid assignments over ``variables`` with the rest fixed."""
+    block = model.block(variables)
+    dependents = tuple(var for var in block if var not in variables)
+    checks = model.checks(block)
+    weights = {var: model.value_weights(var) for var in dependents}
+    fixed = [model.values[var][assignment[var]] for var in dependents]
+
+    def keeps(var, value, selected):
+        current = model.values[var][value]
+        if current is None or selected is None:
+            return current is selected
+        return current.key == selected.key
+
+    for values in product(*(range(model.sizes[var]) for var in variables)):
+        row = list(assignment)
+        for var, value in zip(variables, values):
+            row[var] = value
+        choices, choice_weights = _block_choices(
+            dependents,
+            row,
+            model.sizes,
+            weights,
+            checks,
+        )
+        if not choices:
+            continue
+        best = max(
+            range(len(choices)),
+            key=lambda index: (
+                sum(
+                    keeps(var, value, selected)
+                    for var, value, selected in zip(dependents, choices[index], fixed)
+                ),
+                choice_weights[index],
+                -index,
+            ),
+        )
+        for var, value in zip(dependents, choices[best]):
+            row[var] = value
+        yield row
+
+
+def _linked_change(model, units, k, assignment, rng, budget):
+    """Return the first group of at most ``k`` linked units that can change.
+
+    Units are linked when a constraint involves both of them.  A group
+    whose units split into unlinked parts can only change when one part
+    can change on its own, so growing connected groups one unit at a time
+    visits every group worth trying.  Returns None when none can change.
+    """
+    owner = {var: unit for unit in units for var in unit}
+    links = {}
+    for unit in units:
+        linked = set()
+        for var in model.block(unit):
+            for position in model.watching[var]:
+                scope, _table = model.constraints[position]
+                linked.update(owner[other] for other in scope if other in owner)
+        linked.discard(unit)
+        links[unit] = linked
+    groups = [frozenset([unit]) for unit in units]
+    for _size in range(1, k):
+        grown = {
+            group | {other}
+            for group in groups
+            for unit in group
+            for other in links[unit]
+            if other not in group
+        }
+        groups = sorted(grown, key=lambda group: sorted(group))
+        rng.shuffle(groups)
+        for group in groups:
+            budget.check()
+            if _can_change(
+                model,
+                model.block(var for unit in group for var in unit),
+                assignment,
+            ):
+                return list(group)
+    return None
+
+
+def _changeable(model, assignment, k):
+    """Return the dimensions of ``assignment`` that can be redrawn, as variables.
+
+    A multi-select dimension is redrawn as a whole, even when it is empty.
+    """
+    present = []
+    for var, value in enumerate(assignment):
+        if var in model.multi_owner:
+            variables = model.multi_vars[model.multi_owner[var]]
+            if var == variables[0]:
+                present.append(variables)
+        elif model.values[var][value] is not None:
+            present.append((var,))
+    if not 0 <= k <= len(present):
+        raise ValueError(f"k must be between 0 and {len(present)}")
+    return present
+
+
+class _Network:
+    """Variable sizes and constraints, enough to build an _Elimination."""
+
+    def __init__(self, sizes, constraints):
+        self.sizes = sizes
+        self.constraints = constraints
+
+
+def _block_elimination(model, block, assignment):
+    """Return elimination tables over ``block`` with the rest of ``assignment`` fixed.
+
+    The tables are indexed by position in ``block``.
+    """
+    local = {var: position for position, var in enumerate(block)}
+    constraints = []
+    for scope, table in model.checks(block):
+        inside = [position for position, var in enumerate(scope) if var in local]
+        fixed = [
+            (position, assignment[var])
+            for position, var in enumerate(scope)
+            if var not in local
+        ]
+        constraints.append(
+            (
+                tuple(local[scope[position]] for position in inside),
+                {
+                    tuple(values[position] for position in inside): 1
+                    for values in table
+                    if all(values[position] == value for position, value in fixed)
+                },
+            )
+        )
+    network = _Network(tuple(model.sizes[var] for var in block), constraints)
+    return _Elimination(network, [model.value_weights(var) for var in block])
+
+
+def _block_choices(block, assignment, sizes, weights, checks):
+    """List the valid values of ``block`` given the rest of ``assignment``.
+
+    Only the options of the block are visited and only ``checks`` are
+    evaluated; ``assignment`` is restored before returning.
+    """
+    current = [assignment[var] for var in block]
+    choices = []
+    choice_weights = []
+    for values in product(*(range(sizes[var]) for var in block)):
+        weight = 1.0
+        for var, value in zip(block, values):
+            assignment[var] = value
+            weight *= weights[var][value]
+        if _satisfied(assignment, checks):
+            choices.append(values)
+            choice_weights.append(weight)
+    for var, value in zip(block, current):
+        assignment[var] = value
+    return choices, choice_weights
+
+
+def _satisfied(assignment, constraints):
+    return all(
+        tuple(assignment[var] for var in scope) in table
+        for scope, table in constraints
+    )
+
+
+def _effective_sample_size(rows, sizes, budget):
+    """Smallest effective sample size over every option indicator series."""
+    smallest = float(len(rows))
+    for var in range(len(sizes)):
+        column = [row[var] for row in rows]
+        for value in set(column):
+            smallest = min(
+                smallest,
+                _series_effective_size(
+                    [float(item == value) for item in column],
+                    budget,
+                ),
+            )
+    return smallest
+
+
+def _series_effective_size(series, budget):
+    """Effective size of one series with Geyer's initial positive sequence.
+
+    Autocorrelations are summed in pairs of lags up to the first pair that
+    is not positive.  With NumPy they all come from one FFT; otherwise each
+    lag is computed only when the sum reaches it.
+    """
+    size = len(series)
+    mean = sum(series) / size
+    centered = [item - mean for item in series]
+    variance = sum(item * item for item in centered)
+    if not variance:
+        return float(size)
+
+    if numpy is None:
+
+        def correlation(lag):
+            return (
+                sum(
+                    centered[index] * centered[index + lag]
+                    for index in range(size - lag)
+                )
+                / variance
+            )
+
+    else:
+        spectrum = numpy.fft.rfft(numpy.asarray(centered), 2 * size)
+        correlations = numpy.fft.irfft(spectrum * spectrum.conjugate())[:size]
+        correlations = (correlations / variance).tolist()
+        correlation = correlations.__getitem__
+
+    time = -1.0
+    lag = 0
+    while lag + 1 < size:
+        budget.check()
+        pair = correlation(lag) + correlation(lag + 1)
+        if pair <= 0:
+            break
+        time += 2 * pair
+        lag += 2
+    return size / time
+
+
+class _VectorSampler:
+    """Dense NumPy form of an elimination, drawing whole batches per dimension.
+
+    Each bucket becomes a table with one row of cumulative weights over all
+    values for every assignment of its context, addressed by a mixed-radix
+    context number.
+    """
+
+    chunk = 65536
+
+    def __init__(self, elimination, sizes):
+        self.sizes = sizes
+        self.buckets = []
+        for var, context, rows in reversed(elimination.buckets):
+            strides = []
+            stride = 1
+            for other in reversed(context):
+                strides.insert(0, stride)
+                stride *= sizes[other]
+            table = numpy.zeros((stride, sizes[var]))
+            for assignment, (values, cumulative) in rows.items():
+                weights = numpy.zeros(sizes[var])
+                weights[list(values)] = numpy.diff(cumulative, prepend=0)
+                table[sum(value * step for value, step in zip(assignment, strides))] = (
+                    numpy.cumsum(weights)
+                )
+            self.buckets.append((var, context, strides, table))
+
+    def sample(self, n, generator):
+        columns = [None] * len(self.sizes)
+        for var, context, strides, table in self.buckets:
+            contexts = numpy.zeros(n, dtype=numpy.int64)
+            for other, step in zip(context, strides):
+                contexts += columns[other].astype(numpy.int64) * step
+            uniforms = generator.random(n)
+            column = numpy.empty(n, dtype=numpy.min_scalar_type(self.sizes[var] - 1))
+            for start in range(0, n, self.chunk):
+                cumulative = table[contexts[start : start + self.chunk]]
+                targets = uniforms[start : start + self.chunk] * cumulative[:, -1]
+                column[start : start + self.chunk] = numpy.minimum(
+                    (cumulative <= targets[:, None]).sum(axis=1),
+                    self.sizes[var] - 1,
+                )
+            columns[var] = column
+        return columns
+
+
+def _halton(n, dimensions, rng):
+    """Return ``n`` points of a Halton sequence scrambled by ``rng``.
+
+    Every coordinate uses its own prime base, with a random permutation of
+    the digits at each of the leading positions and a random offset below
+    the last one, so each point stays uniform while the first ``b ** k``
+    points still fall into different intervals of width ``b ** -k``.
+    """
+    if not dimensions:
+        return [()] * n
+    coordinates = []
+    for base in _primes(dimensions):
+        levels = 1
+        while base**levels < n:
+            levels += 1
+        permutations = [rng.sample(range(base), base) for _level in range(levels)]
+        column = []
+        for index in range(n):
+            value = 0.0
+            scale = 1.0
+            for permutation in permutations:
+                index, digit = divmod(index, base)
+                scale /= base
+                value += permutation[digit] * scale
+            column.append(value + rng.random() * scale)
+        coordinates.append(column)
+    return list(zip(*coordinates))
+
+
+def _primes(count):
+    primes = []
+    candidate = 2
+    while len(primes) < count:
+        if all(candidate % prime for prime in primes):
+            primes.append(candidate)
+        candidate += 1
+    return primes
+
+
+def _gumbel(rng):
+    uniform = rng.random()
+    while not uniform:
+        uniform = rng.random()
+    return -log(-log(uniform))
+
+
+def _truncated_gumbel(bound, top, perturbed):
+    """Shift a Gumbel sample so that its siblings' maximum ``top`` becomes ``bound``."""
+    difference = perturbed - top
+    if not difference:
+        return bound
+    # log(1 - exp(difference)), accurate for differences near zero.
+    if difference > -0.693:
+        log_rest = log(-expm1(difference))
+    else:
+        log_rest = log1p(-exp(difference))
+    value = bound - perturbed + log_rest
+    return bound - max(0.0, value) - log1p(exp(-abs(value)))
+
+
+def _typecode(size):
+    """Return the smallest unsigned array typecode that holds ``size`` values."""
+    for typecode in ("B", "H", "L"):
+        if size <= 1 << (8 * array(typecode).itemsize):
+            return typecode
+    return "Q"
+
+
+def _itemsize(column):
+    return column.itemsize if numpy is None else numpy.asarray(column).itemsize
+
+
+def _column_bytes(column):
+    """Serialize an index column as little-endian unsigned integers."""
+    if numpy is not None:
+        column = numpy.asarray(column)
+        return column.astype(column.dtype.newbyteorder("<")).tobytes()
+    if sys.byteorder == "big":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _column_from_bytes(data, itemsize):
+    if numpy is not None:
+        return numpy.frombuffer(data, dtype=f"<u{itemsize}")
+    typecode = next(code for code in "BHILQ" if array(code).itemsize == itemsize)
+    column = array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+
+def _elimination_order(sizes, scopes):
+    """Greedy min-weight elimination order over the interaction graph."""
+    neighbours = _interaction_graph(sizes, scopes)
+
+    def cost(var):
+        return _bucket_size(var, neighbours, sizes), -var
+
+    remaining = set(range(len(sizes)))
+    order = []
+    while remaining:
+        var = min(remaining, key=cost)
+        remaining.remove(var)
+        order.append(var)
+        _remove_variable(var, neighbours)
+    return order
+
+
+def _elimination_states(sizes, scopes, order):
+    """Count the table rows bucket elimination builds in ``order``."""
+    neighbours = _interaction_graph(sizes, scopes)
+    states = 0
+    for var in order:
+        states += _bucket_size(var, neighbours, sizes)
+        _remove_variable(var, neighbours)
+    return states
+
+
+def _interaction_graph(sizes, scopes):
+    neighbours = [set() for _size in sizes]
+    for scope in scopes:
+        for var in scope:
+            neighbours[var].update(scope)
+    for var, connected in enumerate(neighbours):
+        connected.discard(var)
+    return neighbours
+
+
+def _bucket_size(var, neighbours, sizes):
+    size = sizes[var]
+    for other in neighbours[var]:
+        size *= sizes[other]
+    return size
+
+
+def _remove_variable(var, neighbours):
+    for other in neighbours[var]:
+        neighbours[other].update(neighbours[var])
+        neighbours[other].discard(other)
+        neighbours[other].discard(var)
+
+
+def _draw(values, cumulative, uniform):
+    """Pick the value whose cumulative weight interval contains ``uniform``."""
+    return values[bisect(cumulative, uniform * cumulative[-1], 0, len(values) - 1)]
+
+
+def _apportion(n, shares):
+    """Split ``n`` into whole counts proportional to ``shares``.
+
+    Uses the largest remainder method, so the counts always add up to ``n``
+    and integer shares that already add up to ``n`` are kept as they are.
+    """
+    whole = sum(shares.values())
+    exact = {key: n * share / whole for key, share in shares.items()}
+    counts = {key: int(value) for key, value in exact.items()}
+    by_remainder = sorted(exact, key=lambda key: counts[key] - exact[key])
+    for key in by_remainder[: n - sum(counts.values())]:
+        counts[key] += 1
+    return counts
+
+
+def _quota_plan(weights, remaining, rng, budget):
+    """Split the quota counts over option combinations, or return None.
+
+    ``remaining`` holds the counts owed to every option of every quota
+    dimension, and ``weights`` maps the option index tuples that a valid
+    scene can have to their total weight.  Returns how many scenes take each
+    combination.  Every step gives one scene the first option still owed in
+    the first dimension, trying combinations in a random order weighted by
+    ``weights``.  Counts that fail the pairwise transport check between two
+    dimensions are cut at once, and counts that cannot be split are
+    remembered, so the search never repeats itself.
+    """
+    pairs = {
+        (first, second): {
+            (combination[first], combination[second]) for combination in weights
+        }
+        for first, second in combinations(range(len(remaining)), 2)
+    }
+    failed = set()
+
+    def steps(state):
+        owed = next(index for index, count in enumerate(state[0]) if count)
+        keyed = [
+            (rng.random() ** (1 / weight), combination)
+            for combination, weight in weights.items()
+            if combination[0] == owed
+            and all(left[index] for left, index in zip(state, combination))
+        ]
+        for _key, combination in sorted(keyed, reverse=True):
+            yield combination, _quota_taken(state, combination)
+
+    def fits(state):
+        return all(
+            _transportable(state[first], state[second], allowed)
+            for (first, second), allowed in pairs.items()
+        )
+
+    if not fits(remaining):
+        return None
+    stack = [(remaining, None, steps(remaining))]
+    while stack:
+        budget.check()
+        state, _combination, children = stack[-1]
+        if not state or not any(state[0]):
+            plan = {}
+            for _state, combination, _children in stack[1:]:
+                plan[combination] = plan.get(combination, 0) + 1
+            return plan
+        for combination, after in children:
+            if after in failed:
+                continue
+            if not fits(after):
+                failed.add(after)
+                continue
+            stack.append((after, combination, steps(after)))
+            break
+        else:
+            failed.add(state)
+            stack.pop()
+    return None
+
+
+def _quota_taken(remaining, combination):
+    return tuple(
+        left[:index] + (left[index] - 1,) + left[index + 1 :]
+        for left, index in zip(remaining, combination)
+    )
+
+
+def _transportable(supply, demand, allowed):
+    """Return whether ``supply`` counts can be moved to ``demand`` along ``allowed``.
+
+    A max-flow with shortest augmenting paths over a capacity matrix; both
+    sides hold the same total.
+    """
+    size = len(supply) + len(demand) + 2
+    sink = size - 1
+    capacity = [[0] * size for _node in range(size)]
+    for index, amount in enumerate(supply):
+        capacity[0][1 + index] = amount
+    for index, amount in enumerate(demand):
+        capacity[1 + len(supply) + index][sink] = amount
+    needed = sum(supply)
+    for first, second in allowed:
+        capacity[1 + first][1 + len(supply) + second] = needed
+    while needed:
+        parents = [None] * size
+        parents[0] = 0
+        queue = [0]
+        for node in queue:
+            for other, spare in enumerate(capacity[node]):
+                if spare and parents[other] is None:
+                    parents[other] = node
+                    queue.append(other)
+        if parents[sink] is None:
+            return False
+        amount = needed
+        node = sink
+        while node:
+            amount = min(amount, capacity[parents[node]][node])
+            node = parents[node]
+        node = sink
+        while node:
+            capacity[parents[node]][node] -= amount
+            capacity[node][parents[node]] += amount
+            node = parents[node]
+        needed -= amount
+    return True
+
+
+def _eliminate(var, bucket, sizes, reduce):
+    context = tuple(sorted({other for scope, _ in bucket for other in scope} - {var}))
+    scope = context + (var,)
+    lookups = [
+        (tuple(scope.index(other) for other in factor_scope), table)
+        for factor_scope, table in bucket
+    ]
+    rows = {}
+    message = {}
+    for assignment in product(*(range(sizes[other]) for other in context)):
+        values = []
+        weights = []
+        for value in range(sizes[var]):
+            full = assignment + (value,)
+            weight = 1
+            for positions, table in lookups:
+                weight *= table.get(tuple(full[position] for position in positions), 0)
+                if not weight:
+                    break
+            if weight:
+                values.append(value)
+                weights.append(weight)
+        if values:
+            rows[assignment] = (tuple(values), tuple(accumulate(weights)))
+            message[assignment] = reduce(weights)
+    return context, rows, (context, message)
+
+
+def _source_hash():
+    # Tables compiled by an edited prompt_cdk.py are never reused.
+    try:
+        with open(__file__, "rb") as source:
+            return hashlib.sha256(source.read()).hexdigest()[:16]
+    except OSError:
+        return "unknown"
+
+
+_SOURCE_HASH = _source_hash()
+
+
+def _cached(key):
+    entries = _compiled_cache["entries"]
+    if key in entries:
+        entries.move_to_end(key)
+        return entries[key]
+    directory = _compiled_cache["directory"]
+    if directory is None:
+        return None
+    try:
+        with open(os.path.join(directory, f"{key}.pickle"), "rb") as file:
+            data = file.read()
+        compiled = pickle.loads(data)
+    except Exception:  # A missing, partial or stale file is only a cache miss.
+        return None
+    _remember(key, compiled, len(data))
+    return compiled
+
+
+def _store(key, compiled):
+    # The pickled length doubles as the table's size in the memory cache.
+    data = pickle.dumps(compiled, protocol=pickle.HIGHEST_PROTOCOL)
+    _remember(key, compiled, len(data))
+    directory = _compiled_cache["directory"]
+    if directory is None:
+        return
+    path = os.path.join(directory, f"{key}.pickle")
+    try:
+        with open(f"{path}.{os.getpid()}.tmp", "wb") as file:
+            file.write(data)
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+    except OSError:
+        # Persistence is best effort; the table is still cached in memory.
+        pass
+
+
+def _remember(key, compiled, size):
+    _compiled_cache["entries"][key] = compiled
+    _compiled_cache["sizes"][key] = size
+    _trim_cache()
+
+
+def _trim_cache():
+    entries = _compiled_cache["entries"]
+    sizes = _compiled_cache["sizes"]
+    max_bytes = _compiled_cache["max_bytes"]
+    total = sum(sizes.get(key, 0) for key in entries)
+    while entries and (
+        len(entries) > _compiled_cache["maxsize"]
+        or (max_bytes is not None and total > max_bytes)
+    ):
+        key, _compiled = entries.popitem(last=False)
+        total -= sizes.pop(key, 0)
+
+
+def _fingerprint_data(value):
+    """Convert program structure to JSON data independent of hash order."""
+    if isinstance(value, frozenset):
+        return sorted(value)
+    if isinstance(value, (list, tuple)):
+        return [_fingerprint_data(item) for item in value]
+    if is_dataclass(value):
+        return [type(value).__name__] + [
+            _fingerprint_data(getattr(value, field.name)) for field in fields(value)
+        ]
+    return value
+
+
+def _parse_program_file(path, content):
+    if path.endswith(".toml"):
+        if tomllib is None:
+            raise ValueError("TOML program files need Python 3.11 or later")
+        return tomllib.loads(content.decode("utf-8"))
+    return json.loads(content)
+
+
+def _read_program_files(path):
+    """Read a program file and its includes; return data, dimensions and bytes."""
+    with open(path, "rb") as file:
+        content = file.read()
+    data = _parse_program_file(path, content)
+    contents = [(path, content)]
+    dimensions = {}
+    for include in data.get("include", []):
+        include = os.path.join(os.path.dirname(path), include)
+        with open(include, "rb") as file:
+            included = file.read()
+        contents.append((include, included))
+        dimensions.update(
+            _dimension_definitions(
+                _parse_program_file(include, included).get("dimensions", {}),
+                include,
+            )
+        )
+    dimensions.update(_dimension_definitions(data.get("dimensions", {}), path))
+    return data, dimensions, contents
+
+
+def _file_stamps(files):
+    stamps = []
+    for file in files:
+        try:
+            status = os.stat(file)
+        except OSError:
+            stamps.append((file, None, None))
+        else:
+            stamps.append((file, status.st_mtime_ns, status.st_size))
+    return tuple(stamps)
+
+
+def _dimension_definitions(definitions, path):
+    return {
+        reference: dimension(
+            _field(definition, "name", path),
+            *[_option_from_data(item, path) for item in definition.get("options", [])],
+            break_before=definition.get("break_before", False),
+        )
+        for reference, definition in definitions.items()
+    }
+
+
+def _build_elements(target, elements, dimensions, path):
+    """Apply program file elements to a PromptProgram or PromptBlock."""
+    for element in elements:
+        if "block" in element:
+            if not isinstance(target, PromptProgram):
+                raise ValueError(f"Blocks cannot be nested in {path}")
+            block = target.block(
+                element["block"],
+                element.get("fixed"),
+                break_before=element.get("break_before", False),
+            )
+            _build_elements(block, element.get("elements", []), dimensions, path)
+        elif "when" in element:
+            name, criteria = _condition_from_data(element["when"], path)
+            builder = target.when(name, **criteria)
+            for mode in ("require", "forbid"):
+                if mode in element:
+                    name, criteria = _condition_from_data(element[mode], path)
+                    getattr(builder, mode)(name, **criteria)
+                    break
+            else:
+                builder.dimension(*_dimension_from_data(element, dimensions, path))
+        elif "dimension" in element or "use" in element:
+            target.dimension(
+                *_dimension_from_data(element, dimensions, path),
+                break_before=element.get("break_before", False),
+                min=element.get("min"),
+                max=element.get("max"),
+            )
+        elif "fixed" in element:
+            target.fixed(element["fixed"])
+        elif element.get("break"):
+            target.break_()
+        else:
+            raise ValueError(f"Unknown program element in {path}: {element}")
+
+
+def _dimension_from_data(element, dimensions, path):
+    if "use" in element:
+        if element["use"] not in dimensions:
+            raise KeyError(f"Unknown shared dimension in {path}: {element['use']}")
+        return (dimensions[element["use"]],)
+    return (
+        element["dimension"],
+        *[_option_from_data(item, path) for item in element.get("options", [])],
+    )
+
+
+def _condition_from_data(data, path):
+    unknown = set(data) - {"dimension", "key", "keys", "tag", "tags", "match"}
+    if unknown:
+        raise ValueError(f"Unknown condition field in {path}: {sorted(unknown)[0]}")
+    criteria = {field: value for field, value in data.items() if field != "dimension"}
+    return _field(data, "dimension", path), criteria
+
+
+def _option_from_data(data, path):
+    if isinstance(data, list):
+        return option(*data)
+    unknown = set(data) - {
+        "key",
+        "prompt",
+        "tags",
+        "weight",
+        "negative",
+        "break_before",
+    }
+    if unknown:
+        raise ValueError(f"Unknown option field in {path}: {sorted(unknown)[0]}")
+    return option(
+        _field(data, "key", path),
+        _field(data, "prompt", path),
+        *data.get("tags", ()),
+        weight=data.get("weight", 1.0),
+        negative=data.get("negative", ""),
+        break_before=data.get("break_before", False),
+    )
+
+
+def _field(data, name, path):
+    if name not in data:
+        raise ValueError(f"Missing field in {path}: {name}")
+    return data[name]
+
+
+def _validate_engine(engine, burn_in, thin):
+    if engine not in {"auto", "sequential", "enumerate", "rejection", "gibbs"}:
+        raise ValueError(
+            "engine must be 'auto', 'sequential', 'enumerate', 'rejection' or 'gibbs'"
+        )
+    if burn_in < 0:
+        raise ValueError("burn_in must not be negative")
+    if thin < 1:
+        raise ValueError("thin must be at least 1")
+
+
 def _dimension_arguments(name, options):
     if not isinstance(name, Dimension):
         return name, options, False
@@ -533,6 +3813,31 @@ def _validate_dimension(name, options):
         raise TypeError("Dimension options must be created with option()")
 
 
+def _chosen_options(selected):
+    """Return the options of a selection entry, which may be a tuple."""
+    if selected is None:
+        return ()
+    if isinstance(selected, tuple):
+        return selected
+    return (selected,)
+
+
+def _selection_bounds(name, options, minimum, maximum):
+    minimum = 0 if minimum is None else minimum
+    maximum = len(options) if maximum is None else maximum
+    if minimum < 0:
+        raise ValueError("min must not be negative")
+    if minimum > len(options):
+        raise ValueError(f"min is larger than the number of options of {name}")
+    if maximum < minimum:
+        raise ValueError("max must be at least min")
+    if maximum < 1:
+        raise ValueError("max must be at least 1")
+    if len({selected.key for selected in options}) < len(options):
+        raise ValueError(f"Multi-select options need distinct keys: {name}")
+    return minimum, min(maximum, len(options))
+
+
 def _normalize_fragments(value, function_name):
     error_message = (
         f"{function_name}() accepts a string or a list of strings"
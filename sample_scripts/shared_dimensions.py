@@ -1,18 +1,15 @@
 """Reusable prompt dimensions shared by multiple generation scripts."""
 
-from prompt_cdk import dimension, option
+import os
 
+from prompt_cdk import load_dimensions
 
-HAIR_LENGTH = dimension(
-    "hair_length",
-    option("short", "short hair"),
-    option("medium", "medium-length hair"),
-    option("long", "long hair"),
-)
 
-FACE_EXPRESSION = dimension(
-    "face",
-    option("smile", "smiling face"),
-    option("serious", "serious expression"),
-    option("crying", "crying face"),
+# The definitions live in shared_dimensions.json so that program files can
+# include the same dimensions.
+_DIMENSIONS = load_dimensions(
+    os.path.join(os.path.dirname(__file__), "shared_dimensions.json")
 )
+
+HAIR_LENGTH = _DIMENSIONS["HAIR_LENGTH"]
+FACE_EXPRESSION = _DIMENSIONS["FACE_EXPRESSION"]
@@ -1,6 +1,22 @@
-from random import choice
-
-from sample_scripts.prompt_cdk import PromptProgram, dimension, option
+import json
+import os
+from collections import Counter
+from itertools import combinations
+from math import comb, prod
+from pathlib import Path
+from random import Random, choice
+
+from sample_scripts.prompt_cdk import (
+    PromptProgram,
+    Scene,
+    SceneBatch,
+    clear_cache,
+    configure_cache,
+    dimension,
+    load_dimensions,
+    load_program,
+    option,
+)
 
 
 def test_prompt_renders_each_option_on_its_own_line():
@@ -552,3 +568,1818 @@ def test_program_namespace_works_for_block_rule_targets():
         scene = program.synth(seed=seed)
         if scene.selection["girl.pose"].key == "sofa":
             assert scene.selection["situation"].key == "living"
+
+
+def test_sequential_engine_handles_large_programs():
+    program = PromptProgram("LargeProgram")
+    for index in range(12):
+        program.dimension(
+            f"dimension{index}",
+            *[
+                option(f"option{value}", f"fragment {index} {value}", f"tag{value % 3}")
+                for value in range(8)
+            ],
+        )
+    for index in range(11):
+        program.when(f"dimension{index}", tag="tag0").forbid(
+            f"dimension{index + 1}",
+            tag="tag1",
+        )
+
+    scene = program.synth(seed=1)
+
+    assert len(scene.selection) == 12
+    for index in range(11):
+        if scene.selection[f"dimension{index}"].has_tag("tag0"):
+            assert not scene.selection[f"dimension{index + 1}"].has_tag("tag1")
+
+
+def test_sequential_engine_matches_weighted_valid_combinations():
+    program = PromptProgram("SequentialDistribution")
+    program.dimension(
+        "location",
+        option("beach", "sunny beach", "beach"),
+        option("home", "living room", "indoor"),
+    )
+    program.dimension(
+        "outfit",
+        option("swimsuit", "one-piece swimsuit", "swimwear", weight=2.0),
+        option("casual", "sweater and jeans", "casual"),
+    )
+    program.when("location", tag="beach").require("outfit", tag="swimwear")
+    program.when("location", tag="indoor").forbid("outfit", tag="swimwear")
+
+    summaries = [program.synth(seed=seed).summary() for seed in range(3000)]
+
+    assert all(
+        summary in (
+            {"location": "beach", "outfit": "swimsuit"},
+            {"location": "home", "outfit": "casual"},
+        )
+        for summary in summaries
+    )
+    beach = sum(summary["location"] == "beach" for summary in summaries)
+    assert abs(beach / len(summaries) - 2 / 3) < 0.03
+
+
+def test_enumerate_engine_remains_available():
+    program = PromptProgram("EnumerateEngine")
+    program.dimension(
+        "location",
+        option("beach", "sunny beach", "beach"),
+        option("home", "living room", "indoor"),
+    )
+    program.dimension(
+        "outfit",
+        option("swimsuit", "one-piece swimsuit", "swimwear"),
+        option("casual", "sweater and jeans", "casual"),
+    )
+    program.when("location", tag="indoor").forbid("outfit", tag="swimwear")
+
+    for seed in range(20):
+        scene = program.synth(seed=seed, engine="enumerate")
+        if scene.selection["location"].key == "home":
+            assert scene.selection["outfit"].key == "casual"
+
+
+def test_synth_rejects_unknown_engine():
+    program = PromptProgram("UnknownEngine")
+    program.dimension("location", option("beach", "sunny beach"))
+
+    try:
+        program.synth(seed=1, engine="magic")
+    except ValueError as error:
+        assert str(error) == (
+            "engine must be 'auto', 'sequential', 'enumerate', 'rejection' or 'gibbs'"
+        )
+    else:
+        raise AssertionError("Unknown engine should fail")
+
+
+def test_conflicting_rules_report_no_valid_combinations():
+    program = PromptProgram("Conflict")
+    program.dimension("location", option("beach", "sunny beach", "beach"))
+    program.dimension("outfit", option("casual", "sweater and jeans", "casual"))
+    program.when("location", tag="beach").require("outfit", tag="swimwear")
+
+    try:
+        program.synth(seed=1)
+    except ValueError as error:
+        assert str(error).startswith("No valid prompt combinations for Conflict")
+    else:
+        raise AssertionError("Conflicting rules should fail")
+
+
+def test_repeated_synth_calls_reuse_compiled_program():
+    program = PromptProgram("RepeatedSynth")
+    program.dimension(
+        "location",
+        option("beach", "sunny beach"),
+        option("home", "living room"),
+    )
+
+    first = [program.synth(seed=seed).summary() for seed in range(10)]
+    second = [program.synth(seed=seed).summary() for seed in range(10)]
+
+    assert first == second
+
+
+def test_synth_recompiles_after_program_changes():
+    program = PromptProgram("ChangedProgram")
+    program.dimension(
+        "location",
+        option("beach", "sunny beach", "beach"),
+        option("home", "living room", "indoor"),
+    )
+    program.dimension(
+        "outfit",
+        option("swimsuit", "one-piece swimsuit", "swimwear"),
+        option("casual", "sweater and jeans", "casual"),
+    )
+    program.synth(seed=1)
+
+    program.when("location", tag="indoor").forbid("outfit", tag="swimwear")
+    program.dimension("weather", option("sunny", "sunny weather"))
+    program.fixed("highly detailed")
+
+    for seed in range(30):
+        scene = program.synth(seed=seed)
+        assert scene.summary()["weather"] == "sunny"
+        assert scene.prompt(prefix="").endswith("highly detailed")
+        if scene.selection["location"].key == "home":
+            assert scene.selection["outfit"].key == "casual"
+
+
+def test_enumerate_engine_prunes_rules_during_expansion():
+    program = PromptProgram("PrunedEnumeration")
+    colors = ["red", "blue", "green", "white", "black", "pink"]
+    for index in range(8):
+        program.dimension(
+            f"item{index}",
+            *[option(color, f"{color} item {index}") for color in colors],
+        )
+    for index in range(7):
+        for color in colors:
+            program.when(f"item{index}", key=color).require(
+                f"item{index + 1}",
+                key=color,
+            )
+
+    scene = program.synth(seed=3, engine="enumerate")
+
+    assert len(set(scene.summary().values())) == 1
+    assert list(scene.summary()) == [f"item{index}" for index in range(8)]
+
+
+def test_scene_selection_behaves_like_a_mapping():
+    program = PromptProgram("SelectionView")
+    program.dimension(
+        "situation",
+        option("studio", "photo studio"),
+    )
+    program.dimension("face", option("smile", "smiling face"))
+    program.when("situation", key="beach").dimension(
+        "action",
+        option("beach_bed", "sitting on a beach bed"),
+    )
+
+    for engine in ("sequential", "enumerate"):
+        selection = program.synth(seed=1, engine=engine).selection
+
+        assert list(selection) == ["situation", "face"]
+        assert len(selection) == 2
+        assert selection == {
+            "situation": program.dimensions["situation"][0],
+            "face": program.dimensions["face"][0],
+        }
+        assert "action" not in selection
+        assert selection.get("action") is None
+        try:
+            selection["action"]
+        except KeyError:
+            pass
+        else:
+            raise AssertionError("Absent dimensions should raise KeyError")
+
+
+def test_prompt_values_are_slotted():
+    selected = option("hero", "brave hero", "character")
+
+    assert not hasattr(selected, "__dict__")
+
+
+def test_count_and_total_weight_match_valid_combinations():
+    program = PromptProgram("Counting")
+    program.dimension(
+        "location",
+        option("beach", "sunny beach", "beach", weight=2.0),
+        option("home", "living room", "indoor"),
+        option("park", "green park", "outdoor"),
+    )
+    program.dimension(
+        "outfit",
+        option("swimsuit", "one-piece swimsuit", "swimwear", weight=3.0),
+        option("casual", "sweater and jeans", "casual"),
+    )
+    program.when("location", tag="beach").require("outfit", tag="swimwear")
+    program.when("location", tag="indoor").forbid("outfit", tag="swimwear")
+    program.when("location", key="beach").dimension(
+        "towel",
+        option("striped", "striped beach towel"),
+        option("plain", "plain beach towel", weight=0.5),
+    )
+
+    # beach+swimsuit (x2 towels), home+casual, park+swimsuit, park+casual
+    assert program.count() == 5
+    assert program.total_weight() == 2.0 * 3.0 * 1.5 + 1.0 + 3.0 + 1.0
+
+
+def test_count_does_not_enumerate_the_product_space():
+    program = PromptProgram("LargeCount")
+    for index in range(20):
+        program.dimension(
+            f"dimension{index}",
+            *[option(f"option{value}", f"fragment {value}") for value in range(8)],
+        )
+    program.when("dimension0", key="option0").forbid("dimension19", key="option0")
+
+    assert program.count() == 8**20 - 8**18
+    assert program.total_weight() == float(8**20 - 8**18)
+
+
+def test_count_is_zero_for_conflicting_rules():
+    program = PromptProgram("NoCombinations")
+    program.dimension("location", option("beach", "sunny beach", "beach"))
+    program.dimension("outfit", option("casual", "sweater and jeans", "casual"))
+    program.when("location", tag="beach").require("outfit", tag="swimwear")
+
+    assert program.count() == 0
+    assert program.total_weight() == 0
+
+
+def _ranked_program():
+    program = PromptProgram("Ranked")
+    program.dimension(
+        "location",
+        option("beach", "sunny beach", "beach"),
+        option("home", "living room", "indoor"),
+        option("park", "green park", "outdoor"),
+    )
+    program.dimension(
+        "outfit",
+        option("swimsuit", "one-piece swimsuit", "swimwear"),
+        option("casual", "sweater and jeans", "casual"),
+    )
+    program.when("location", tag="beach").require("outfit", tag="swimwear")
+    program.when("location", tag="indoor").forbid("outfit", tag="swimwear")
+    program.when("location", key="beach").dimension(
+        "towel",
+        option("striped", "striped beach towel"),
+        option("plain", "plain beach towel"),
+    )
+    return program
+
+
+def test_scene_at_addresses_every_valid_scene_in_order():
+    program = _ranked_program()
+
+    summaries = [
+        program.scene_at(index).summary()
+        for index in range(program.count())
+    ]
+
+    assert summaries == [
+        {"location": "beach", "outfit": "swimsuit", "towel": "striped"},
+        {"location": "beach", "outfit": "swimsuit", "towel": "plain"},
+        {"location": "home", "outfit": "casual"},
+        {"location": "park", "outfit": "swimsuit"},
+        {"location": "park", "outfit": "casual"},
+    ]
+
+
+def test_index_of_is_the_inverse_of_scene_at():
+    program = _ranked_program()
+
+    for index in range(program.count()):
+        assert program.index_of(program.scene_at(index)) == index
+    for seed in range(20):
+        scene = program.synth(seed=seed)
+        assert program.scene_at(program.index_of(scene)).summary() == scene.summary()
+
+
+def test_scene_at_rejects_out_of_range_index():
+    program = _ranked_program()
+
+    try:
+        program.scene_at(program.count())
+    except IndexError as error:
+        assert str(error) == "Scene index out of range: 5"
+    else:
+        raise AssertionError("Out of range index should fail")
+
+
+def test_index_of_rejects_invalid_scene():
+    program = _ranked_program()
+    location = program.dimensions["location"]
+    outfit = program.dimensions["outfit"]
+    invalid = Scene({"location": location[1], "outfit": outfit[0]}, ())
+
+    try:
+        program.index_of(invalid)
+    except ValueError as error:
+        assert str(error) == "Scene is not a valid combination of Ranked"
+    else:
+        raise AssertionError("Invalid scene should fail")
+
+
+def test_index_of_rejects_trailing_break():
+    program = _ranked_program()
+    scene = program.scene_at(0)
+    program.break_()
+
+    try:
+        program.index_of(scene)
+    except ValueError as error:
+        assert str(error) == "break_() must be followed by prompt content"
+    else:
+        raise AssertionError("Trailing break_() should fail")
+
+
+def test_scene_at_handles_large_index_spaces():
+    program = PromptProgram("LargeIndex")
+    for index in range(20):
+        program.dimension(
+            f"dimension{index}",
+            *[option(f"option{value}", f"fragment {value}") for value in range(8)],
+        )
+
+    scene = program.scene_at(8**20 - 1)
+
+    assert set(scene.summary().values()) == {"option7"}
+    assert program.index_of(scene) == 8**20 - 1
+
+
+def _beach_program():
+    program = PromptProgram("BeachBatch")
+    program.dimension(
+        "location",
+        option("beach", "sunny beach", "beach", weight=2.0),
+        option("home", "living room", "indoor"),
+    )
+    program.dimension(
+        "outfit",
+        option("swimsuit", "one-piece swimsuit", "swimwear"),
+        option("casual", "sweater and jeans", "casual"),
+    )
+    program.when("location", tag="beach").require("outfit", tag="swimwear")
+    program.when("location", tag="indoor").forbid("outfit", tag="swimwear")
+    return program
+
+
+def _assert_beach_batch(batch):
+    summaries = [scene.summary() for scene in batch]
+    assert len(batch) == len(summaries) == 2000
+    assert all(
+        summary in (
+            {"location": "beach", "outfit": "swimsuit"},
+            {"location": "home", "outfit": "casual"},
+        )
+        for summary in summaries
+    )
+    beach = sum(summary["location"] == "beach" for summary in summaries)
+    assert abs(beach / len(summaries) - 2 / 3) < 0.04
+
+
+def test_synth_many_draws_a_batch_of_valid_scenes():
+    batch = _beach_program().synth_many(2000, seed=1)
+
+    _assert_beach_batch(batch)
+    assert batch[-1].summary() == batch[len(batch) - 1].summary()
+
+
+def test_synth_many_works_without_numpy(monkeypatch):
+    import sample_scripts.prompt_cdk as prompt_cdk
+
+    monkeypatch.setattr(prompt_cdk, "numpy", None)
+
+    _assert_beach_batch(_beach_program().synth_many(2000, seed=1))
+
+
+def test_synth_many_is_reproducible_with_seed():
+    program = _beach_program()
+
+    first = [scene.summary() for scene in program.synth_many(50, seed=7)]
+    second = [scene.summary() for scene in program.synth_many(50, seed=7)]
+
+    assert first == second
+
+
+def test_synth_many_draws_small_programs_with_the_vectorized_sampler():
+    program = _beach_program()
+    expected = program.synth_many(200, seed=4, engine="sequential")
+
+    batch = program.synth_many(200, seed=4)
+
+    assert [scene.summary() for scene in batch] == [
+        scene.summary() for scene in expected
+    ]
+
+
+def test_synth_many_rejects_negative_count():
+    try:
+        _beach_program().synth_many(-1)
+    except ValueError as error:
+        assert str(error) == "n must not be negative"
+    else:
+        raise AssertionError("Negative batch size should fail")
+
+
+def test_qmc_method_spreads_small_batches_by_weight():
+    program = PromptProgram("Styles")
+    program.dimension(
+        "style",
+        option("anime", "anime style", weight=2.0),
+        option("oil", "oil painting"),
+        option("photo", "photograph"),
+    )
+
+    for seed in range(20):
+        batch = program.synth_many(16, seed=seed, method="qmc")
+        styles = [scene.summary()["style"] for scene in batch]
+        assert styles.count("anime") == 8
+        assert styles.count("oil") == 4
+        assert styles.count("photo") == 4
+
+
+def test_qmc_method_draws_valid_scenes_in_proportion():
+    batch = _beach_program().synth_many(2000, seed=1, method="qmc")
+
+    _assert_beach_batch(batch)
+
+
+def test_qmc_method_needs_the_sequential_engine():
+    for arguments, message in (
+        ({"method": "sobol"}, "method must be 'random' or 'qmc'"),
+        (
+            {"method": "qmc", "engine": "gibbs"},
+            "method 'qmc' needs the sequential engine",
+        ),
+    ):
+        try:
+            _beach_program().synth_many(10, seed=1, **arguments)
+        except ValueError as error:
+            assert str(error) == message
+        else:
+            raise AssertionError("Unsupported method should fail")
+
+
+def _weighted_program():
+    program = PromptProgram("Weighted")
+    program.dimension(
+        "location",
+        option("beach", "sunny beach", "beach", weight=3.0),
+        option("home", "living room", "indoor", weight=2.0),
+        option("park", "green park", "outdoor"),
+    )
+    program.dimension(
+        "outfit",
+        option("swimsuit", "one-piece swimsuit", "swimwear", weight=4.0),
+        option("casual", "sweater and jeans", "casual", weight=1.5),
+    )
+    program.when("location", tag="indoor").forbid("outfit", tag="swimwear")
+    return program
+
+
+def test_iter_scenes_follows_scene_at_order():
+    program = _ranked_program()
+
+    summaries = [scene.summary() for scene in program.iter_scenes()]
+
+    assert summaries == [
+        program.scene_at(index).summary() for index in range(program.count())
+    ]
+
+
+def test_iter_scenes_by_weight_yields_the_heaviest_scenes_first():
+    program = _weighted_program()
+
+    summaries = [
+        (scene.summary()["location"], scene.summary()["outfit"])
+        for scene in program.iter_scenes(order="weight")
+    ]
+
+    assert summaries == [
+        ("beach", "swimsuit"),
+        ("beach", "casual"),
+        ("park", "swimsuit"),
+        ("home", "casual"),
+        ("park", "casual"),
+    ]
+
+
+def test_top_k_returns_the_heaviest_scenes_as_a_batch():
+    program = _weighted_program()
+
+    batch = program.top_k(2)
+
+    assert [scene.summary() for scene in batch] == [
+        {"location": "beach", "outfit": "swimsuit"},
+        {"location": "beach", "outfit": "casual"},
+    ]
+    assert len(program.top_k(10)) == 5
+    assert len(program.top_k(0)) == 0
+
+
+def test_top_k_and_iter_scenes_validate_arguments():
+    program = _weighted_program()
+
+    for call, message in (
+        (lambda: program.top_k(-1), "k must not be negative"),
+        (
+            lambda: program.iter_scenes(order="random"),
+            "order must be 'index' or 'weight'",
+        ),
+    ):
+        try:
+            call()
+        except ValueError as error:
+            assert str(error) == message
+        else:
+            raise AssertionError("Invalid arguments should fail")
+
+
+def _beach_scene(program):
+    return next(
+        scene
+        for scene in program.iter_scenes()
+        if scene.summary()
+        == {"location": "beach", "outfit": "swimsuit", "towel": "striped"}
+    )
+
+
+def test_mutate_changes_one_dimension_within_the_rules():
+    program = _ranked_program()
+    scene = _beach_scene(program)
+
+    variations = {
+        tuple(sorted(scene.mutate(1, seed=seed).summary().items()))
+        for seed in range(50)
+    }
+
+    # The outfit cannot change at the beach, so it is never the one picked,
+    # and leaving the beach removes the towel.
+    assert variations == {
+        (("location", "beach"), ("outfit", "swimsuit"), ("towel", "plain")),
+        (("location", "park"), ("outfit", "swimsuit")),
+    }
+
+
+def _pinned_program(*backgrounds):
+    program = PromptProgram("Pinned")
+    program.dimension("style", option("anime", "anime style"), option("photo", "photo"))
+    program.dimension("hair", option("pink", "pink hair"), option("brown", "brown hair"))
+    if backgrounds:
+        program.dimension(
+            "background",
+            *[option(background, background) for background in backgrounds],
+        )
+    program.when("style", key="anime").require("hair", key="pink")
+    program.when("hair", key="pink").require("style", key="anime")
+    return program
+
+
+def test_mutate_skips_dimensions_pinned_by_the_rules():
+    scene = next(
+        scene
+        for scene in _pinned_program("city", "forest", "sea").iter_scenes()
+        if scene.summary()["style"] == "anime"
+    )
+
+    for seed in range(100):
+        variation = scene.mutate(1, seed=seed).summary()
+        assert variation["background"] != scene.summary()["background"]
+        assert variation["style"] == "anime"
+        assert variation["hair"] == "pink"
+
+    # Neither dimension can change alone, but both can change together.
+    scene = _pinned_program().scene_at(0)
+    for seed in range(10):
+        assert scene.mutate(2, seed=seed).summary() != scene.summary()
+
+
+def test_mutate_only_tries_groups_linked_by_rules():
+    program = PromptProgram("Single", time_limit=5)
+    for index in range(40):
+        program.dimension(f"d{index}", option("only", f"only {index}"))
+    scene = program.synth(seed=1)
+
+    assert scene.mutate(6, seed=1).summary() == scene.summary()
+
+    pinned = _pinned_program()
+    scene = pinned.scene_at(0)
+    pinned.time_limit = 0
+    try:
+        scene.mutate(2, seed=1)
+    except TimeoutError as error:
+        assert str(error) == "Pinned did not finish within 0 seconds"
+    else:
+        raise AssertionError("An exhausted time limit should stop the search")
+
+
+def test_mutate_redraws_several_dimensions():
+    program = PromptProgram("Free")
+    for name in ("hair", "eyes", "outfit"):
+        program.dimension(
+            name,
+            *(option(f"{name}{index}", f"{name} {index}") for index in range(4)),
+        )
+    scene = program.synth(seed=1)
+
+    for seed in range(20):
+        variation = scene.mutate(2, seed=seed)
+        changed = [
+            name
+            for name, key in variation.summary().items()
+            if key != scene.summary()[name]
+        ]
+        assert 1 <= len(changed) <= 2
+        program.index_of(variation)
+
+
+def test_neighbors_lists_every_scene_one_dimension_away():
+    program = _ranked_program()
+
+    neighbors = program.neighbors(_beach_scene(program))
+
+    assert [scene.summary() for scene in neighbors] == [
+        {"location": "beach", "outfit": "swimsuit", "towel": "plain"},
+        {"location": "park", "outfit": "swimsuit"},
+    ]
+    assert len(program.neighbors(_beach_scene(program), k=3)) == program.count() - 1
+
+
+def test_mutate_and_neighbors_reject_invalid_requests():
+    program = _ranked_program()
+    scene = _beach_scene(program)
+    detached = Scene(dict(scene.selection), scene.elements)
+
+    for call, error_type, message in (
+        (lambda: scene.mutate(4), ValueError, "k must be between 0 and 3"),
+        (
+            lambda: detached.mutate(1),
+            TypeError,
+            "Only scenes selected by a PromptProgram can be mutated",
+        ),
+        (
+            lambda: program.neighbors(
+                Scene(
+                    {**detached.selection, "outfit": program.dimensions["outfit"][1]},
+                    scene.elements,
+                )
+            ),
+            ValueError,
+            "Scene is not a valid combination of Ranked",
+        ),
+    ):
+        try:
+            call()
+        except error_type as error:
+            assert str(error) == message
+        else:
+            raise AssertionError("Invalid requests should fail")
+
+
+def test_grid_varies_only_the_listed_dimensions():
+    program = _ranked_program()
+    fix = _beach_scene(program)
+
+    summaries = [
+        scene.summary() for scene in program.grid(["location", "outfit"], fix=fix)
+    ]
+
+    # The towel keeps its option at the beach and disappears elsewhere.
+    assert summaries == [
+        {"location": "beach", "outfit": "swimsuit", "towel": "striped"},
+        {"location": "home", "outfit": "casual"},
+        {"location": "park", "outfit": "swimsuit"},
+        {"location": "park", "outfit": "casual"},
+    ]
+
+
+def test_grid_resolves_conditional_dimensions_that_appear():
+    program = _weighted_program()
+    program.when("location", key="beach").dimension(
+        "towel",
+        option("striped", "striped beach towel"),
+        option("plain", "plain beach towel", weight=2.0),
+    )
+    fix = next(
+        scene
+        for scene in program.iter_scenes()
+        if scene.summary() == {"location": "park", "outfit": "swimsuit"}
+    )
+
+    summaries = [scene.summary() for scene in program.grid(["location"], fix=fix)]
+
+    assert summaries == [
+        {"location": "beach", "outfit": "swimsuit", "towel": "plain"},
+        {"location": "park", "outfit": "swimsuit"},
+    ]
+
+
+def test_grid_starts_from_the_heaviest_scene_and_stays_lazy():
+    program = PromptProgram("Wide")
+    for index in range(16):
+        program.dimension(
+            f"d{index}",
+            option("light", f"d{index} light"),
+            option("heavy", f"d{index} heavy", weight=2.0),
+            option("other", f"d{index} other"),
+        )
+
+    first = next(program.grid([f"d{index}" for index in range(15)]))
+
+    assert first.summary() == {
+        **{f"d{index}": "light" for index in range(15)},
+        "d15": "heavy",
+    }
+
+
+def test_grid_rejects_unknown_dimensions():
+    try:
+        _ranked_program().grid(["weather"])
+    except KeyError as error:
+        assert str(error) == "'Unknown dimension: weather'"
+    else:
+        raise AssertionError("Unknown dimensions should fail")
+
+
+def _accessory_program():
+    program = PromptProgram("Accessories")
+    program.dimension(
+        "location",
+        option("beach", "sunny beach", "beach", weight=2),
+        option("office", "office", "indoor"),
+    )
+    program.dimension(
+        "accessories",
+        option("hat", "straw hat", "sun"),
+        option("glasses", "sunglasses", "sun", weight=3),
+        option("tie", "necktie", "formal"),
+        option("watch", "wristwatch", weight=0.5),
+        min=1,
+        max=2,
+    )
+    program.when("location", tag="beach").forbid("accessories", tag="formal")
+    program.when("accessories", tag="sun").require("location", tag="beach")
+    return program
+
+
+def _valid_accessories():
+    keys = ("hat", "glasses", "tie", "watch")
+    weights = {"hat": 1, "glasses": 3, "tie": 1, "watch": 0.5}
+    valid = {}
+    for location, location_weight in (("beach", 2), ("office", 1)):
+        for size in (1, 2):
+            for chosen in combinations(keys, size):
+                if location == "beach" and "tie" in chosen:
+                    continue
+                if location == "office" and {"hat", "glasses"} & set(chosen):
+                    continue
+                valid[location, chosen] = location_weight * prod(
+                    weights[key] for key in chosen
+                )
+    return valid
+
+
+def _accessory_pairs(scenes):
+    pairs = set()
+    for scene in scenes:
+        summary = scene.summary()
+        options = [("location", summary["location"])] + [
+            ("accessories", key) for key in summary["accessories"]
+        ]
+        pairs.update(combinations(sorted(options), 2))
+    return pairs
+
+
+def test_multi_select_dimensions_pick_between_min_and_max_options():
+    program = _accessory_program()
+    valid = _valid_accessories()
+
+    assert program.count() == len(valid)
+    assert program.total_weight() == sum(valid.values())
+    scene = program.synth(seed=3)
+    chosen = scene.summary()["accessories"]
+    assert isinstance(chosen, tuple)
+    assert (scene.summary()["location"], chosen) in valid
+    assert scene.selection["accessories"] == tuple(
+        selected
+        for selected in program.dimensions["accessories"]
+        if selected.key in chosen
+    )
+    assert scene.prompt("").splitlines()[1:] == [
+        selected.prompt + ("," if index < len(chosen) - 1 else "")
+        for index, selected in enumerate(scene.selection["accessories"])
+    ]
+
+
+def test_multi_select_subsets_are_drawn_in_proportion_to_their_weight():
+    program = _accessory_program()
+    valid = _valid_accessories()
+    total = sum(valid.values())
+
+    for engine in ("sequential", "rejection"):
+        counts = Counter(
+            (scene.summary()["location"], scene.summary()["accessories"])
+            for scene in program.synth_many(6000, seed=1, engine=engine)
+        )
+        assert set(counts) <= set(valid)
+        for key, weight in valid.items():
+            assert abs(counts[key] / 6000 - weight / total) < 0.03
+
+
+def test_multi_select_dimensions_count_subsets_without_listing_them():
+    program = PromptProgram("ManyAccessories")
+    program.dimension(
+        "accessories",
+        *[option(f"item{index}", f"item {index}") for index in range(30)],
+        min=2,
+        max=4,
+    )
+
+    assert program.count() == sum(comb(30, size) for size in (2, 3, 4))
+    for scene in program.synth_many(50, seed=1):
+        assert 2 <= len(scene.summary()["accessories"]) <= 4
+    scene = program.scene_at(12345)
+    assert program.index_of(scene) == 12345
+    assert len(program.neighbors(scene)) == program.count() - 1
+    mutated = scene.mutate(seed=1)
+    assert mutated.summary() != scene.summary()
+    assert 2 <= len(mutated.summary()["accessories"]) <= 4
+
+
+def test_multi_select_dimensions_work_with_analysis_and_calibration():
+    program = _accessory_program()
+    valid = _valid_accessories()
+    total = sum(valid.values())
+
+    marginals = program.marginals()["accessories"]
+    for key in ("hat", "glasses", "tie", "watch"):
+        expected = sum(
+            weight for (_location, chosen), weight in valid.items() if key in chosen
+        )
+        assert abs(marginals[key] - expected / total) < 1e-9
+    assert _accessory_pairs(program.covering_set()) == _accessory_pairs(
+        program.iter_scenes()
+    )
+
+    program.calibrate({"accessories": {"watch": 0.5, "hat": 0.2}})
+    marginals = program.marginals()["accessories"]
+    assert abs(marginals["watch"] - 0.5) < 1e-6
+    assert abs(marginals["hat"] - 0.2) < 1e-6
+
+    beach = PromptProgram("Beach")
+    beach.dimension("location", option("beach", "sunny beach", "beach"))
+    beach.dimension(
+        "accessories",
+        option("hat", "straw hat"),
+        option("tie", "necktie", "formal"),
+        max=2,
+    )
+    beach.when("location", tag="beach").forbid("accessories", tag="formal")
+    assert beach.analyze().dead_options == {"accessories": ("tie",)}
+
+
+def test_multi_select_dimensions_validate_their_bounds():
+    options = (option("hat", "straw hat"), option("tie", "necktie"))
+    for kwargs, message in (
+        ({"min": -1}, "min must not be negative"),
+        ({"min": 2, "max": 1}, "max must be at least min"),
+        ({"max": 0}, "max must be at least 1"),
+        ({"min": 3}, "min is larger than the number of options of accessories"),
+    ):
+        try:
+            PromptProgram("Invalid").dimension("accessories", *options, **kwargs)
+        except ValueError as error:
+            assert str(error) == message
+        else:
+            raise AssertionError("Invalid bounds should fail")
+
+    program = _accessory_program()
+    for call, message in (
+        (
+            lambda: program.synth(engine="enumerate"),
+            "The enumerate engine does not support multi-select dimensions",
+        ),
+        (
+            lambda: program.grid(["accessories"]),
+            "Cannot vary a multi-select dimension: accessories",
+        ),
+        (
+            lambda: program.sample_stratified(4, {"accessories": {"hat": 1}}),
+            "Quotas are not supported for multi-select dimension: accessories",
+        ),
+    ):
+        try:
+            call()
+        except ValueError as error:
+            assert str(error) == message
+        else:
+            raise AssertionError("Unsupported operations should fail")
+
+
+def test_scene_batch_renders_rows_on_demand():
+    program = _beach_program()
+    batch = program.synth_many(10, seed=3)
+
+    for index, scene in enumerate(batch):
+        assert batch.prompt(index, prefix="best quality") == scene.prompt(
+            "best quality"
+        )
+        assert batch.negative_prompt(index, "low quality") == (
+            scene.negative_prompt("low quality")
+        )
+
+
+def test_scene_batch_supports_slicing_and_concatenation():
+    program = _beach_program()
+    batch = program.synth_many(10, seed=3)
+    summaries = [scene.summary() for scene in batch]
+
+    head = batch[:4]
+    tail = batch[4:]
+    joined = head + tail
+
+    assert len(head) == 4
+    assert [scene.summary() for scene in batch[::3]] == summaries[::3]
+    assert [scene.summary() for scene in joined] == summaries
+    assert len(SceneBatch.concatenate([batch, batch, batch])) == 30
+
+
+def test_scene_batch_rejects_batches_from_other_programs():
+    batch = _beach_program().synth_many(3, seed=1)
+    other = PromptProgram("Other")
+    other.dimension("location", option("park", "green park"))
+
+    try:
+        batch + other.synth_many(3, seed=1)
+    except ValueError as error:
+        assert str(error) == (
+            "Scene batches from different programs cannot be combined"
+        )
+    else:
+        raise AssertionError("Combining unrelated batches should fail")
+
+
+def test_scene_batch_round_trips_through_disk(tmp_path):
+    program = _beach_program()
+    batch = program.synth_many(100, seed=5)
+    path = tmp_path / "batch.zip"
+
+    batch.save(path)
+    loaded = SceneBatch.load(path, _beach_program())
+
+    assert [scene.summary() for scene in loaded] == [
+        scene.summary() for scene in batch
+    ]
+
+
+def test_scene_batch_load_requires_matching_program(tmp_path):
+    path = tmp_path / "batch.zip"
+    _beach_program().synth_many(5, seed=5).save(path)
+    other = PromptProgram("Other")
+    other.dimension("location", option("park", "green park"))
+
+    try:
+        SceneBatch.load(path, other)
+    except ValueError as error:
+        assert str(error) == "Saved scene batch does not match program Other"
+    else:
+        raise AssertionError("Loading into a different program should fail")
+
+
+def test_sample_distinct_returns_different_valid_scenes():
+    program = _ranked_program()
+
+    batch = program.sample_distinct(program.count(), seed=2)
+    summaries = [scene.summary() for scene in batch]
+
+    assert sorted(map(str, summaries)) == sorted(
+        str(program.scene_at(index).summary())
+        for index in range(program.count())
+    )
+
+
+def test_sample_distinct_scales_to_large_programs():
+    program = PromptProgram("LargeDistinct")
+    for index in range(12):
+        program.dimension(
+            f"dimension{index}",
+            *[
+                option(f"option{value}", f"fragment {value}", weight=value + 1)
+                for value in range(8)
+            ],
+        )
+    program.when("dimension0", key="option7").forbid("dimension1", key="option7")
+
+    batch = program.sample_distinct(500, seed=4)
+    summaries = [tuple(scene.summary().values()) for scene in batch]
+
+    assert len(set(summaries)) == 500
+    assert all(
+        not (summary[0] == "option7" and summary[1] == "option7")
+        for summary in summaries
+    )
+
+
+def test_sample_distinct_rejects_more_scenes_than_combinations():
+    program = _ranked_program()
+
+    try:
+        program.sample_distinct(6, seed=1)
+    except ValueError as error:
+        assert str(error) == (
+            "Cannot select 6 distinct scenes from 5 valid combinations of Ranked"
+        )
+    else:
+        raise AssertionError("Requesting too many distinct scenes should fail")
+
+
+def test_sample_stratified_meets_quotas_exactly():
+    program = _ranked_program()
+
+    batch = program.sample_stratified(
+        10,
+        {"location": {"home": 1, "beach": 1}, "outfit": {"swimsuit": 1, "casual": 1}},
+        seed=3,
+    )
+
+    summaries = [scene.summary() for scene in batch]
+    assert len(summaries) == 10
+    # Rules tie home to casual and beach to swimsuit, so every quota
+    # combination is forced.
+    assert sorted((s["location"], s["outfit"]) for s in summaries) == (
+        [("beach", "swimsuit")] * 5 + [("home", "casual")] * 5
+    )
+    for scene in batch:
+        program.index_of(scene)
+
+
+def test_sample_stratified_splits_shares_into_whole_counts():
+    program = _ranked_program()
+
+    batch = program.sample_stratified(7, {"towel": {None: 2, "striped": 1}}, seed=1)
+
+    towels = [scene.summary().get("towel") for scene in batch]
+    assert towels.count(None) == 5
+    assert towels.count("striped") == 2
+    assert {
+        scene.summary()["location"] for scene in batch if scene.summary().get("towel")
+    } == {"beach"}
+
+
+def test_sample_stratified_checks_quota_dimensions_together():
+    program = PromptProgram("Joint")
+    for name in ("a", "b", "c"):
+        program.dimension(
+            name,
+            option(f"{name}0", f"{name} zero"),
+            option(f"{name}1", f"{name} one"),
+        )
+    program.when("c", key="c0").require("a", key="a0")
+    program.when("c", key="c0").require("b", key="b0")
+    quotas = {name: {f"{name}0": 1, f"{name}1": 1} for name in ("a", "b", "c")}
+
+    for seed in range(50):
+        batch = program.sample_stratified(2, quotas, seed=seed)
+        assert sorted(tuple(scene.summary().values()) for scene in batch) == [
+            ("a0", "b0", "c0"),
+            ("a1", "b1", "c1"),
+        ]
+
+
+def test_sample_stratified_rejects_quotas_that_cannot_be_met():
+    program = _ranked_program()
+
+    for quotas, error_type, message in (
+        ({"weather": {"sunny": 1}}, KeyError, "'Unknown dimension: weather'"),
+        ({"location": {"forest": 1}}, KeyError, "'Unknown option: location.forest'"),
+        ({"location": {"home": 0}}, ValueError, "Quota shares must be greater than 0"),
+        (
+            {"location": {"beach": 1}, "outfit": {"casual": 1}},
+            ValueError,
+            "Cannot meet the quotas for outfit in Ranked",
+        ),
+    ):
+        try:
+            program.sample_stratified(4, quotas, seed=1)
+        except error_type as error:
+            assert str(error) == message
+        else:
+            raise AssertionError("Unreachable quotas should fail")
+
+
+def _option_pairs(scenes):
+    pairs = set()
+    for scene in scenes:
+        options = sorted(
+            (name, key) for name, key in scene.summary().items() if key is not None
+        )
+        for index, first in enumerate(options):
+            pairs.update((first, second) for second in options[index + 1 :])
+    return pairs
+
+
+def test_covering_set_covers_every_valid_pair():
+    program = _ranked_program()
+    every_scene = [program.scene_at(index) for index in range(program.count())]
+
+    batch = program.covering_set()
+
+    assert _option_pairs(batch) == _option_pairs(every_scene)
+    assert len(batch) <= len(every_scene)
+    for scene in batch:
+        program.index_of(scene)
+
+
+def test_covering_set_stays_small_for_many_dimensions():
+    program = PromptProgram("Wide")
+    for index in range(12):
+        options = [
+            option(f"o{value}", f"d{index} o{value}", f"t{value}") for value in range(3)
+        ]
+        program.dimension(f"d{index}", *options)
+    program.when("d0", tag="t0").forbid("d1", tag="t1")
+
+    batch = program.covering_set(strength=2)
+
+    pairs = _option_pairs(batch)
+    assert len(pairs) == 66 * 9 - 1
+    assert (("d0", "o0"), ("d1", "o1")) not in pairs
+    assert len(batch) <= 30
+
+
+def test_covering_set_rejects_strength_below_one():
+    try:
+        _ranked_program().covering_set(strength=0)
+    except ValueError as error:
+        assert str(error) == "strength must be at least 1"
+    else:
+        raise AssertionError("Strength 0 should fail")
+
+
+def test_enumerate_engine_samples_independent_blocks_separately():
+    program = PromptProgram("IndependentBlocks")
+    for block_name in ("girl", "room"):
+        block = program.block(block_name, block_name)
+        for index in range(5):
+            block.dimension(
+                f"detail{index}",
+                *[
+                    option(f"option{value}", f"{block_name} {index} {value}")
+                    for value in range(5)
+                ],
+            )
+        block.when("detail0", key="option0").forbid("detail4", key="option0")
+
+    for seed in range(10):
+        summary = program.synth(seed=seed, engine="enumerate").summary()
+        assert list(summary) == [
+            f"{block_name}.detail{index}"
+            for block_name in ("girl", "room")
+            for index in range(5)
+        ]
+        for block_name in ("girl", "room"):
+            assert not (
+                summary[f"{block_name}.detail0"] == "option0"
+                and summary[f"{block_name}.detail4"] == "option0"
+            )
+
+
+def test_gibbs_engine_visits_valid_scenes_in_proportion():
+    program = _ranked_program()
+    batch = program.synth_many(4000, seed=3, engine="gibbs", burn_in=10)
+
+    counts = {}
+    for scene in batch:
+        summary = tuple(scene.summary().items())
+        counts[summary] = counts.get(summary, 0) + 1
+    valid = {tuple(program.scene_at(index).summary().items()) for index in range(5)}
+    assert set(counts) == valid
+    for summary, count in counts.items():
+        assert abs(count / len(batch) - 1 / 5) < 0.05, summary
+    assert 0 < batch.effective_sample_size <= len(batch)
+
+
+def test_gibbs_engine_respects_conditional_branches():
+    for seed in range(10):
+        summary = _ranked_program().synth(seed=seed, engine="gibbs").summary()
+        assert ("towel" in summary) == (summary["location"] == "beach")
+        if summary["location"] == "beach":
+            assert summary["outfit"] == "swimsuit"
+        if summary["location"] == "home":
+            assert summary["outfit"] == "casual"
+
+
+def test_gibbs_engine_starts_quickly_on_many_dimensions_with_dense_rules():
+    rng = Random(1)
+    program = PromptProgram("Dense", time_limit=10)
+    for index in range(30):
+        program.dimension(
+            f"d{index}",
+            *[option(f"o{value}", f"d{index} o{value}") for value in range(6)],
+        )
+    rules = []
+    for _index in range(40):
+        first, second = rng.sample(range(30), 2)
+        rules.append(
+            (f"d{first}", f"o{rng.randrange(6)}", f"d{second}", f"o{rng.randrange(6)}")
+        )
+    for trigger, trigger_key, target, target_key in rules:
+        program.when(trigger, key=trigger_key).require(target, key=target_key)
+
+    for scene in program.synth_many(50, seed=1, engine="gibbs", burn_in=5):
+        summary = scene.summary()
+        for trigger, trigger_key, target, target_key in rules:
+            assert summary[trigger] != trigger_key or summary[target] == target_key
+
+
+def test_only_gibbs_batches_report_effective_sample_size():
+    program = _ranked_program()
+
+    assert program.synth_many(10, seed=1).effective_sample_size is None
+    assert program.synth_many(10, seed=1, engine="gibbs").effective_sample_size
+
+
+def test_effective_sample_size_does_not_depend_on_numpy(monkeypatch):
+    import sample_scripts.prompt_cdk as prompt_cdk
+
+    program = _ranked_program()
+    expected = program.synth_many(3000, seed=2, engine="gibbs").effective_sample_size
+    monkeypatch.setattr(prompt_cdk, "numpy", None)
+
+    size = program.synth_many(3000, seed=2, engine="gibbs").effective_sample_size
+
+    assert abs(size - expected) < 1e-6 * expected
+
+
+def test_gibbs_engine_validates_burn_in_and_thinning():
+    program = _ranked_program()
+
+    for arguments, message in (
+        ({"burn_in": -1}, "burn_in must not be negative"),
+        ({"thin": 0}, "thin must be at least 1"),
+    ):
+        try:
+            program.synth(seed=1, engine="gibbs", **arguments)
+        except ValueError as error:
+            assert str(error) == message
+        else:
+            raise AssertionError("Invalid chain settings should be rejected")
+
+
+def test_gibbs_engine_reports_programs_without_valid_scenes():
+    program = PromptProgram("Impossible")
+    program.dimension("mood", option("happy", "smiling"))
+    program.when("mood", key="happy").forbid("mood", key="happy")
+
+    try:
+        program.synth(seed=1, engine="gibbs")
+    except ValueError as error:
+        assert str(error).startswith("No valid prompt combinations for Impossible")
+    else:
+        raise AssertionError("A program without valid scenes should fail")
+
+
+def _chain_program(length, **limits):
+    program = PromptProgram("Chain", **limits)
+    keys = [f"color{value}" for value in range(6)]
+    for index in range(length):
+        program.dimension(
+            f"layer{index}",
+            *[option(key, f"{key} layer {index}") for key in keys],
+        )
+    for index in range(length - 1):
+        for key in keys:
+            program.when(f"layer{index}", key=key).forbid(
+                f"layer{index + 1}",
+                key=key,
+            )
+    return program
+
+
+def _assert_chain_scene(scene, length):
+    summary = scene.summary()
+    for index in range(length - 1):
+        assert summary[f"layer{index}"] != summary[f"layer{index + 1}"]
+
+
+def test_rejection_engine_draws_valid_scenes_in_proportion():
+    program = _ranked_program()
+    batch = program.synth_many(4000, seed=3, engine="rejection")
+
+    counts = {}
+    for scene in batch:
+        summary = tuple(scene.summary().items())
+        counts[summary] = counts.get(summary, 0) + 1
+    assert len(counts) == 5
+    for summary, count in counts.items():
+        assert abs(count / len(batch) - 1 / 5) < 0.05, summary
+
+
+def test_max_states_stops_engines_before_building_large_tables():
+    program = _chain_program(8, max_states=100)
+
+    for engine in ("sequential", "enumerate"):
+        try:
+            program.synth(seed=1, engine=engine)
+        except ValueError as error:
+            assert "more than max_states=100" in str(error)
+        else:
+            raise AssertionError(f"The {engine} engine should exceed max_states")
+
+
+def test_auto_engine_stays_within_max_states():
+    for length in (8, 20):
+        program = _chain_program(length, max_states=100)
+        for seed in range(5):
+            _assert_chain_scene(program.synth(seed=seed), length)
+        for scene in program.synth_many(20, seed=1):
+            _assert_chain_scene(scene, length)
+
+
+def test_auto_engine_avoids_gibbs_when_rules_pin_two_dimensions():
+    program = _chain_program(20, max_states=100)
+    assert program.synth_many(5, seed=1).engine == "gibbs"
+
+    program.dimension("style", option("anime", "anime style"), option("photo", "photo"))
+    program.dimension("hair", option("pink", "pink hair"), option("brown", "brown hair"))
+    program.when("style", key="anime").require("hair", key="pink")
+    program.when("hair", key="pink").require("style", key="anime")
+    batch = program.synth_many(200, seed=1)
+
+    assert batch.engine == "rejection"
+    assert batch[:10].engine == "rejection"
+    for scene in batch:
+        _assert_chain_scene(scene, 20)
+    assert {scene.summary()["style"] for scene in batch} == {"anime", "photo"}
+
+
+def test_time_limit_raises_instead_of_running_on():
+    program = _chain_program(20, time_limit=0)
+
+    try:
+        program.synth(seed=1, engine="gibbs")
+    except TimeoutError as error:
+        assert str(error) == "Chain did not finish within 0 seconds"
+    else:
+        raise AssertionError("An exhausted time limit should stop the sampler")
+
+
+def test_time_limit_is_finite_unless_disabled():
+    assert PromptProgram("Default").time_limit == 60
+    assert PromptProgram("Unlimited", time_limit=None).time_limit is None
+    assert _chain_program(20, time_limit=None).synth(seed=1, engine="gibbs")
+
+
+def test_analyze_reports_dead_options_and_fixed_dimensions():
+    program = PromptProgram("Analyzed")
+    program.dimension(
+        "location",
+        option("home", "living room", "indoor"),
+        option("park", "green park", "outdoor"),
+    )
+    program.dimension(
+        "outfit",
+        option("swimsuit", "one-piece swimsuit", "swimwear"),
+        option("casual", "sweater and jeans", "casual"),
+    )
+    program.when("location", key="beach").dimension(
+        "towel",
+        option("striped", "striped beach towel"),
+    )
+    program.when("location", tag="indoor").forbid("outfit", tag="swimwear")
+    program.when("location", tag="outdoor").forbid("outfit", tag="swimwear")
+
+    analysis = program.analyze()
+
+    assert analysis.satisfiable
+    assert analysis.conflict == ()
+    assert analysis.dead_options == {
+        "outfit": ("swimsuit",),
+        "towel": ("striped",),
+    }
+    assert analysis.fixed_dimensions == {"outfit": "casual", "towel": None}
+
+
+def test_analyze_finds_a_minimal_conflicting_rule_set():
+    program = PromptProgram("Conflicted")
+    program.dimension(
+        "location",
+        option("beach", "sunny beach", "beach"),
+        option("home", "living room", "indoor"),
+    )
+    program.dimension(
+        "outfit",
+        option("swimsuit", "one-piece swimsuit", "swimwear"),
+        option("casual", "sweater and jeans", "casual"),
+    )
+    program.when("location", tag="beach").require("outfit", tag="swimwear")
+    program.when("outfit", tag="casual").forbid("location", tag="beach")
+    program.when("location", tag="indoor").forbid("outfit", tag="swimwear")
+    program.when("outfit", tag="swimwear").require("location", tag="indoor")
+    program.when("outfit", tag="casual").require("location", tag="beach")
+
+    analysis = program.analyze()
+
+    # The first two rules both exclude a casual outfit at the beach, so one
+    # of them is dropped.
+    assert not analysis.satisfiable
+    assert analysis.conflict == tuple(program.rules[1:])
+    try:
+        program.synth(seed=1)
+    except ValueError as error:
+        assert str(error) == (
+            "No valid prompt combinations for Conflicted:\n"
+            + "\n".join(f"- {rule.describe()}" for rule in analysis.conflict)
+        )
+    else:
+        raise AssertionError("Conflicting rules should fail")
+
+
+def test_marginals_report_exact_selection_frequencies():
+    program = _ranked_program()
+
+    marginals = program.marginals()
+
+    # Each of the five valid scenes is equally likely.
+    expected = {
+        "location": {"beach": 2 / 5, "home": 1 / 5, "park": 2 / 5},
+        "outfit": {"swimsuit": 3 / 5, "casual": 2 / 5},
+        "towel": {None: 3 / 5, "striped": 1 / 5, "plain": 1 / 5},
+    }
+    assert marginals.keys() == expected.keys()
+    for name, frequencies in expected.items():
+        assert marginals[name].keys() == frequencies.keys()
+        for key, frequency in frequencies.items():
+            assert abs(marginals[name][key] - frequency) < 1e-12, (name, key)
+
+
+def test_marginals_reject_trailing_break():
+    program = _ranked_program()
+    program.break_()
+
+    try:
+        program.marginals()
+    except ValueError as error:
+        assert str(error) == "break_() must be followed by prompt content"
+    else:
+        raise AssertionError("Trailing break_() should fail")
+
+
+def test_calibrate_adjusts_weights_to_hit_target_frequencies():
+    program = _ranked_program()
+
+    assert program.calibrate({"location": {"beach": 0.5, "home": 0.3}}) is program
+
+    marginals = program.marginals()
+    assert abs(marginals["location"]["beach"] - 0.5) < 1e-6
+    assert abs(marginals["location"]["home"] - 0.3) < 1e-6
+    assert abs(marginals["location"]["park"] - 0.2) < 1e-6
+    weights = {
+        selected.key: selected.weight
+        for selected in program.dimensions["location"]
+    }
+    assert weights["beach"] != weights["home"]
+    batch = program.synth_many(2000, seed=7)
+    beach = sum(1 for scene in batch if scene.summary()["location"] == "beach")
+    assert abs(beach / len(batch) - 0.5) < 0.04
+
+
+def test_calibrate_stays_within_the_time_limit():
+    program = _ranked_program()
+    program.synth(seed=1, engine="sequential")
+    program.time_limit = 0
+
+    try:
+        program.calibrate({"location": {"beach": 0.5}})
+    except TimeoutError as error:
+        assert str(error) == "Ranked did not finish within 0 seconds"
+    else:
+        raise AssertionError("An exhausted time limit should stop calibration")
+
+
+def test_calibrate_rejects_unknown_or_impossible_targets():
+    program = _ranked_program()
+
+    for targets, error_type, message in (
+        ({"weather": {"sunny": 0.5}}, KeyError, "'Unknown dimension: weather'"),
+        ({"location": {"forest": 0.5}}, KeyError, "'Unknown option: location.forest'"),
+        (
+            {"location": {"beach": 0.7, "home": 0.4}},
+            ValueError,
+            "Target frequencies for location add up to more than 1",
+        ),
+        (
+            {"location": {"beach": 0}},
+            ValueError,
+            "Target frequencies must be greater than 0 and at most 1",
+        ),
+    ):
+        try:
+            program.calibrate(targets)
+        except error_type as error:
+            assert str(error) == message
+        else:
+            raise AssertionError("Invalid targets should fail")
+
+
+def test_tags_missing_from_every_option_never_match():
+    program = PromptProgram("UnknownTags")
+    program.dimension("location", option("beach", "sunny beach", "beach"))
+    program.dimension(
+        "outfit",
+        option("swimsuit", "one-piece swimsuit", "swimwear"),
+        option("casual", "sweater and jeans", "casual"),
+    )
+    program.when("location", tag="beach").forbid(
+        "outfit",
+        tags=["swimwear", "vintage"],
+        match="all",
+    )
+    program.when("location", tag="beach").require(
+        "outfit",
+        tags=["swimwear", "vintage"],
+        match="any",
+    )
+
+    for engine in ("sequential", "enumerate"):
+        assert program.synth(seed=1, engine=engine).summary()["outfit"] == "swimsuit"
+
+
+def test_enumerate_engine_resolves_branches_by_trigger_option():
+    program = PromptProgram("BranchLookup")
+    program.dimension(
+        "location",
+        option("beach", "sunny beach", "beach"),
+        option("home", "living room", "indoor"),
+        option("park", "green park", "outdoor"),
+    )
+    program.dimension(
+        "time",
+        option("day", "bright daylight"),
+        option("night", "starry night"),
+    )
+    program.when("location", tag="beach").dimension(
+        "extra",
+        option("towel", "striped beach towel"),
+    )
+    program.when("location", tag="indoor").dimension(
+        "extra",
+        option("lamp", "warm table lamp"),
+        option("candle", "lit candle"),
+    )
+    program.when("location", key="home").forbid("time", key="day")
+
+    summaries = [
+        program.synth(seed=seed, engine="enumerate").summary() for seed in range(60)
+    ]
+
+    assert {
+        (summary["location"], summary["time"], summary.get("extra"))
+        for summary in summaries
+    } == {
+        ("beach", "day", "towel"),
+        ("beach", "night", "towel"),
+        ("home", "night", "lamp"),
+        ("home", "night", "candle"),
+        ("park", "day", None),
+        ("park", "night", None),
+    }
+
+
+def test_fingerprint_depends_on_structure_but_not_name():
+    first = _ranked_program()
+    second = _ranked_program()
+    second.name = "Renamed"
+
+    assert first.fingerprint() == second.fingerprint()
+    second.when("location", key="park").forbid("outfit", key="swimsuit")
+    assert first.fingerprint() != second.fingerprint()
+
+
+def _fail_to_compile(_program):
+    raise AssertionError("Compiled tables should have been reused")
+
+
+def test_unchanged_programs_reuse_compiled_tables(monkeypatch):
+    expected = _ranked_program().synth(seed=1, engine="sequential").summary()
+    monkeypatch.setattr(PromptProgram, "_compile_weight", _fail_to_compile)
+
+    program = _ranked_program()
+
+    assert program.synth(seed=1, engine="sequential").summary() == expected
+
+
+def test_compiled_tables_can_be_persisted_to_disk(monkeypatch, tmp_path):
+    configure_cache(directory=tmp_path)
+    clear_cache()
+    try:
+        expected = _ranked_program().synth(seed=1, engine="enumerate").summary()
+        clear_cache()
+        monkeypatch.setattr(PromptProgram, "_compile_enumerate", _fail_to_compile)
+
+        program = _ranked_program()
+
+        assert program.synth(seed=1, engine="enumerate").summary() == expected
+        assert list(tmp_path.glob("*-enumerate-*.pickle"))
+    finally:
+        configure_cache()
+
+
+def test_cache_drops_tables_beyond_the_byte_limit(monkeypatch):
+    configure_cache(max_bytes=0)
+    try:
+        _ranked_program().synth(seed=1, engine="sequential")
+        monkeypatch.setattr(PromptProgram, "_compile_weight", _fail_to_compile)
+
+        try:
+            _ranked_program().synth(seed=1, engine="sequential")
+        except AssertionError:
+            pass
+        else:
+            raise AssertionError("A table larger than max_bytes was kept")
+    finally:
+        configure_cache()
+
+
+def test_configure_cache_rejects_a_negative_byte_limit():
+    try:
+        configure_cache(max_bytes=-1)
+    except ValueError as error:
+        assert "max_bytes" in str(error)
+    else:
+        raise AssertionError("A negative max_bytes was accepted")
+
+
+SAMPLE_SCRIPTS = Path(__file__).resolve().parent.parent / "sample_scripts"
+
+
+def test_load_program_builds_the_sample_program_file():
+    program = load_program(SAMPLE_SCRIPTS / "conditional_scene.json")
+
+    assert program.name == "ConditionalScene"
+    assert program.count() == 18
+    for seed in range(20):
+        summary = program.synth(seed=seed).summary()
+        assert summary["girl.action"] == {
+            "beach": "beach_bed",
+            "living": "sofa",
+        }[summary["situation"]]
+        assert ("room" in summary) == (summary["situation"] == "living")
+
+
+def test_load_dimensions_reads_shared_definitions():
+    dimensions = load_dimensions(SAMPLE_SCRIPTS / "shared_dimensions.json")
+
+    assert dimensions["HAIR_LENGTH"].name == "hair_length"
+    assert [item.key for item in dimensions["FACE_EXPRESSION"].options] == [
+        "smile",
+        "serious",
+        "crying",
+    ]
+
+
+def _write_program_file(path, outfit_tag):
+    path.write_text(
+        json.dumps(
+            {
+                "name": "FromFile",
+                "elements": [
+                    {"fixed": "masterpiece"},
+                    {
+                        "dimension": "location",
+                        "options": [
+                            ["beach", "sunny beach", "beach"],
+                            {"key": "home", "prompt": "living room", "tags": ["indoor"]},
+                        ],
+                    },
+                    {"break": True},
+                    {
+                        "dimension": "outfit",
+                        "options": [
+                            ["swimsuit", "one-piece swimsuit", "swimwear"],
+                            ["casual", "sweater and jeans", "casual"],
+                        ],
+                    },
+                    {
+                        "when": {"dimension": "location", "tag": "beach"},
+                        "require": {"dimension": "outfit", "tag": outfit_tag},
+                    },
+                    {
+                        "when": {"dimension": "location", "tag": "indoor"},
+                        "forbid": {"dimension": "outfit", "tag": "swimwear"},
+                    },
+                ],
+            }
+        ),
+        encoding="utf-8",
+    )
+
+
+def test_load_program_reuses_the_program_until_the_file_changes(tmp_path):
+    path = tmp_path / "program.json"
+    _write_program_file(path, "swimwear")
+
+    first = load_program(path)
+    assert load_program(path).fingerprint() == first.fingerprint()
+    assert first.synth(seed=1).prompt("").startswith("masterpiece,\n")
+    assert first.count() == 2
+
+    # Same content with a new modification time keeps the program.
+    status = os.stat(path)
+    os.utime(path, ns=(status.st_atime_ns, status.st_mtime_ns + 10**9))
+    assert load_program(path).fingerprint() == first.fingerprint()
+
+    _write_program_file(path, "casual")
+    os.utime(path, ns=(status.st_atime_ns, status.st_mtime_ns + 2 * 10**9))
+    second = load_program(path)
+    assert second.fingerprint() != first.fingerprint()
+    assert {scene.summary()["outfit"] for scene in second.synth_many(20, seed=1)} == {
+        "casual"
+    }
+
+
+def test_load_program_returns_a_copy_each_caller_can_change(tmp_path):
+    path = tmp_path / "program.json"
+    _write_program_file(path, "swimwear")
+    first = load_program(path)
+    fingerprint = first.fingerprint()
+
+    first.calibrate({"location": {"beach": 0.7}})
+    first.fixed("extra")
+
+    second = load_program(path)
+    assert second is not first
+    assert second.fingerprint() == fingerprint
+    assert first.fingerprint() != fingerprint
+    assert "extra" not in second.synth(seed=1).prompt("")
+
+
+def test_load_program_reads_toml_files(tmp_path):
+    path = tmp_path / "program.toml"
+    path.write_text(
+        """
+name = "FromToml"
+
+[[elements]]
+dimension = "location"
+options = [
+    { key = "beach", prompt = "sunny beach", tags = ["beach"] },
+    { key = "home", prompt = "living room", tags = ["indoor"] },
+]
+
+[[elements]]
+dimension = "outfit"
+options = [
+    { key = "swimsuit", prompt = "one-piece swimsuit", tags = ["swimwear"] },
+    { key = "casual", prompt = "sweater and jeans", weight = 2 },
+]
+
+[[elements]]
+when = { dimension = "location", tag = "indoor" }
+forbid = { dimension = "outfit", tag = "swimwear" }
+""",
+        encoding="utf-8",
+    )
+
+    program = load_program(path)
+
+    assert program.name == "FromToml"
+    assert program.count() == 3
+    assert program.total_weight() == 5
+
+
+def test_load_program_rejects_unknown_fields(tmp_path):
+    path = tmp_path / "invalid.json"
+    path.write_text(
+        json.dumps(
+            {
+                "elements": [
+                    {
+                        "dimension": "location",
+                        "options": [{"key": "beach", "prompt": "beach", "tag": "sea"}],
+                    }
+                ]
+            }
+        ),
+        encoding="utf-8",
+    )
+
+    try:
+        load_program(path)
+    except ValueError as error:
+        assert str(error) == f"Unknown option field in {path}: tag"
+    else:
+        raise AssertionError("Unknown option fields should be rejected")